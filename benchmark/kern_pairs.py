@@ -0,0 +1,88 @@
+import os
+import sys
+import glob
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+from fontTools.ttLib import TTFont
+import kern
+
+
+# the per-pair extractor kern.py used before class-based expansion, kept for comparison
+def LegacyKernPairs(font, cyrillic):
+	gpos = font['GPOS'].table
+	scriptDflt = [ scr for scr in gpos.ScriptList.ScriptRecord if scr.ScriptTag == 'DFLT' ]
+	scriptDfltFeaList = [ gpos.FeatureList.FeatureRecord[i] for i in scriptDflt[0].Script.DefaultLangSys.FeatureIndex ]
+	kernFeaList = [ fea.Feature for fea in scriptDfltFeaList if fea.FeatureTag == 'kern' ]
+	kernLutList = [ gpos.LookupList.Lookup[i] for fea in kernFeaList for i in fea.LookupListIndex ]
+
+	kernPairStList = sum([ lut.SubTable for lut in kernLutList if lut.LookupType == 2 ], [])
+	kernExtLutList = sum([ lut.SubTable for lut in kernLutList if lut.LookupType == 9 ], [])
+	kernPairStList += [ lut.ExtSubTable for lut in kernExtLutList if lut.ExtensionLookupType == 2 ]
+
+	kernSubset = kern.kernSubsetLatin + (kern.kernSubsetCyrillic if cyrillic else "")
+	cmap = font['cmap'].getBestCmap()
+	kernGlyph = {*[ cmap[ord(ch)] for ch in kernSubset ]}
+
+	kernPairs = {}
+	for st in kernPairStList:
+		if st.Format == 1:
+			coverage = st.Coverage.glyphs
+			for i in range(st.PairSetCount):
+				first = coverage[i]
+				if first not in kernGlyph:
+					continue
+				for pairRec in st.PairSet[i].PairValueRecord:
+					second = pairRec.SecondGlyph
+					if second not in kernGlyph:
+						continue
+					value = pairRec.Value1.XAdvance
+					if value:
+						kernPairs[(first, second)] = value
+		elif st.Format == 2:
+			coverage = st.Coverage.glyphs
+			classDef1 = st.ClassDef1.classDefs
+			classDef2 = st.ClassDef2.classDefs
+			for first in coverage:
+				if first not in kernGlyph:
+					continue
+				class1Record = st.Class1Record[classDef1.get(first, 0)]
+				for second in coverage:
+					if second not in kernGlyph:
+						continue
+					value = class1Record.Class2Record[classDef2.get(second, 0)].Value1.XAdvance
+					if value:
+						kernPairs[(first, second)] = value
+	return kernPairs
+
+
+def Measure(function, font, cyrillic, repeat):
+	best = float("inf")
+	for _ in range(repeat):
+		start = time.perf_counter()
+		result = function(font, cyrillic)
+		best = min(best, time.perf_counter() - start)
+	return best, result
+
+
+if __name__ == "__main__":
+	# usage: python benchmark/kern_pairs.py [font ...]
+	files = sys.argv[1:] or sorted(glob.glob("build/unkerned-otf/*.otf"))
+	if not files:
+		print("no fonts to measure, build some `build/unkerned-otf/` targets first", file=sys.stderr)
+		sys.exit(1)
+
+	print("{:<60} {:>10} {:>10} {:>8} {:>8} {:>8}".format("font", "legacy", "class", "pairs", "legacy", "common"))
+	for filename in files:
+		# decompile everything up front, only extraction is measured
+		font = TTFont(filename, lazy=False)
+		font.ensureDecompiled()
+		for cyrillic in (True, False):
+			legacyTime, legacy = Measure(LegacyKernPairs, font, cyrillic, 3)
+			classTime, pairs = Measure(kern.ExtractKernPairs, font, cyrillic, 3)
+			common = sum(1 for k, v in pairs.items() if legacy.get(k) == v)
+			print("{:<60} {:>9.1f}ms {:>9.1f}ms {:>8} {:>8} {:>8}".format(
+				os.path.basename(filename) + (" (Cyrillic)" if cyrillic else ""),
+				legacyTime * 1000, classTime * 1000, len(pairs), len(legacy), common))
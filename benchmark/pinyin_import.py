@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import subprocess
+
+os.chdir(os.path.join(os.path.dirname(__file__), ".."))
+
+
+# start-up cost of the pinyin data in a fresh interpreter, as paid by every
+# merge process: the `pinyindata` dict literal against the mapped table.
+# each case runs once importing cached bytecode and once compiling the
+# module from source, as after a checkout or an edit.
+def Source(module, then=""):
+    return "ns = {{'__file__': '{0}.py', '__name__': '{0}'}}; exec(compile(open('{0}.py', encoding='utf-8').read(), '{0}.py', 'exec'), ns); {1}".format(module, then)
+
+
+case = [
+    ("interpreter", "pass", "pass"),
+    ("pinyindata", "import pinyindata", Source("pinyindata")),
+    ("pinyin", "import pinyin", Source("pinyin")),
+    ("pinyin, first lookup", "import pinyin; pinyin.data['一']",
+     Source("pinyin", "ns['PinyinTable'](ns['dataFile'])['一']")),
+    ("pinyin, full scan", "import pinyin; dict(pinyin.data.items())",
+     Source("pinyin", "dict(ns['PinyinTable'](ns['dataFile']).items())")),
+]
+
+
+def Measure(code, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", code], check=True)
+        best = min(best, time.perf_counter() - start)
+    return best
+
+
+if __name__ == "__main__":
+    # usage: python benchmark/pinyin_import.py [repeat]
+    repeat = int(sys.argv[1]) if len(sys.argv) > 1 else 20
+    subprocess.run([sys.executable, "-m", "compileall", "-q", "pinyindata.py", "pinyin.py"], check=True)
+
+    baseline = Measure("pass", repeat)
+    print("{:<24} {:>10} {:>10}".format("case", "cached", "source"))
+    for name, cached, source in case:
+        print("{:<24} {:>9.1f}ms {:>9.1f}ms".format(
+            name, (Measure(cached, repeat) - baseline) * 1000, (Measure(source, repeat) - baseline) * 1000))
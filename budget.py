@@ -0,0 +1,176 @@
+import os
+import sys
+import json
+import struct
+import tempfile
+
+import numpy as np
+
+import configure
+from sfnt import ReadTableDirectory, ReadCmap
+
+
+# glyph budget of merged fonts, predicted before any merge runs.
+#
+# a merged font is the Latin instance, the part of the SHS instance not
+# shadowed by it, and the romanised glyphs added on top. glyph counts and
+# cmaps do not change when instancing, so they are read from the variable
+# sources and remembered in `metadataFile` by mtime and size.
+#
+# the prediction ignores what garbage collection drops later, so it is an
+# upper bound: a font predicted in budget is in budget.
+glyphLimit = 65535
+metadataFile = "build/glyph-budget.json"
+
+sourceFile = {
+    "Noto": "source/noto/NotoSans-VF.otf",
+    "SHS": "source/shs/{region}-VF.otf",
+}
+
+# glyphs added by romanisation, besides the composed hanzi and hangul
+romanReferenceGlyphs = 61  # letters and marks referenced by composed glyphs
+cyrillicGlyphs = 66  # len(romanise.cyrMap)
+asianSymbolGlyphs = 11  # len(merge.asianSymbol)
+uroRange = (0x4E00, 0xA000)
+
+
+def SourceFile(dep):
+    return sourceFile[dep["family"]].format(**dep)
+
+
+def Stat(filename):
+    stat = os.stat(filename)
+    return "{}:{}".format(stat.st_mtime_ns, stat.st_size)
+
+
+def OutlineBytes(directory):
+    return sum(directory[tag][2] for tag in ("CFF ", "CFF2", "glyf") if tag in directory)
+
+
+class Budget:
+    def __init__(self, filename=metadataFile):
+        self.filename = filename
+        self.metadata = {"source": {}, "pair": {}}
+        try:
+            with open(filename) as f:
+                self.metadata = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.dirty = False
+        self.cmap = {}
+
+    def Cmap(self, filename):
+        if filename not in self.cmap:
+            with open(filename, 'rb') as f:
+                data = f.read()
+            cmap = ReadCmap(data)
+            directory = ReadTableDirectory(data)
+            _, maxpOffset, _ = directory["maxp"]
+            numGlyphs, = struct.unpack_from(">H", data, maxpOffset + 4)
+            self.cmap[filename] = (
+                np.fromiter(cmap.keys(), dtype=np.int64, count=len(cmap)),
+                np.fromiter(cmap.values(), dtype=np.int64, count=len(cmap)),
+                numGlyphs,
+                OutlineBytes(directory),
+            )
+        return self.cmap[filename]
+
+    def Source(self, filename):
+        # per-source metadata: glyph count and outline table size
+        stat = Stat(filename)
+        known = self.metadata["source"].get(filename)
+        if not known or known["stat"] != stat:
+            _, _, numGlyphs, outlineBytes = self.Cmap(filename)
+            known = {"stat": stat, "glyphs": numGlyphs, "outlineBytes": outlineBytes}
+            self.metadata["source"][filename] = known
+            self.dirty = True
+        return known
+
+    def Pair(self, latinFile, cjkFile):
+        # how the CJK source overlaps with the Latin one
+        stat = "{}|{}".format(Stat(latinFile), Stat(cjkFile))
+        key = "{}|{}".format(latinFile, cjkFile)
+        known = self.metadata["pair"].get(key)
+        if not known or known["stat"] != stat:
+            latinCode, _, _, _ = self.Cmap(latinFile)
+            code, gid, _, _ = self.Cmap(cjkFile)
+            covered = np.isin(code, latinCode)
+            # a CJK glyph is dropped by the merge if the Latin font maps all its code points
+            shadowed = np.setdiff1d(gid[covered], gid[~covered])
+            from pinyin import data as pinyinData
+            hanzi = np.array([ord(ch) for ch in pinyinData if uroRange[0] <= ord(ch) < uroRange[1]], dtype=np.int64)
+            from romanise import adobeKr0
+            hanguel = np.array([ord(ch) for ch in adobeKr0], dtype=np.int64)
+            known = {
+                "stat": stat,
+                "shadowed": len(shadowed),
+                "pinyin": int(np.isin(hanzi, code).sum()),
+                "romaja": int(np.isin(hanguel, code).sum()),
+            }
+            self.metadata["pair"][key] = known
+            self.dirty = True
+        return known
+
+    def Predict(self, param):
+        # (glyphs, outline bytes) of the merged font of `param`
+        dep = configure.ResolveDependency(param)
+        latinFile, cjkFile = SourceFile(dep["Latin"]), SourceFile(dep["CJK"])
+        latin = self.Source(latinFile)
+        cjk = self.Source(cjkFile)
+        pair = self.Pair(latinFile, cjkFile)
+
+        cjkGlyphs = cjk["glyphs"] - pair["shadowed"]
+        composed = 0
+        if "Pinyin" in param["feature"]:
+            composed += pair["pinyin"]
+        if "Romaja" in param["feature"]:
+            composed += pair["romaja"]
+        added = composed + (romanReferenceGlyphs if composed else 0)
+        added += cyrillicGlyphs if "CyR" in param["feature"] else 0
+        added += asianSymbolGlyphs if "UI" not in param["feature"] else 0
+        glyphs = latin["glyphs"] + cjkGlyphs + added
+
+        cjkGlyphBytes = cjk["outlineBytes"] / max(cjk["glyphs"], 1)
+        outlineBytes = (latin["outlineBytes"] + cjkGlyphBytes * cjkGlyphs
+                        # a composed glyph repeats its base outline
+                        + cjkGlyphBytes * composed)
+        return glyphs, int(outlineBytes)
+
+    def Plan(self, rule):
+        # predictions for every merge in a makefile rule dict, by target
+        plan = {}
+        for target, recipe in rule.items():
+            stage = recipe.get("stage")
+            if stage and stage[0] == "merge":
+                try:
+                    plan[target] = self.Predict(stage[1])
+                except OSError:
+                    # sources not available, nothing to predict from
+                    pass
+        return plan
+
+    def Save(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.filename) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.metadata, f)
+        os.replace(tmp, self.filename)
+        self.dirty = False
+
+
+def OverBudget(plan):
+    return {target for target, (glyphs, _) in plan.items() if glyphs > glyphLimit}
+
+
+if __name__ == "__main__":
+    # usage: python budget.py [-a]; lists merges over budget, or all with -a
+    showAll = "-a" in sys.argv[1:]
+    budget = Budget()
+    plan = budget.Plan(configure.GenerateMakefile()["rule"])
+    budget.Save()
+    for target, (glyphs, outlineBytes) in sorted(plan.items(), key=lambda x: -x[1][0]):
+        if showAll or glyphs > glyphLimit:
+            print("{:>6} {:>10} {}{}".format(glyphs, outlineBytes, target, " (over budget)" if glyphs > glyphLimit else ""))
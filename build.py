@@ -0,0 +1,360 @@
+import os
+import sys
+import json
+import glob
+import queue
+import argparse
+import importlib
+import multiprocessing
+
+import configure
+from budget import Budget, OverBudget
+from buildcache import BuildCache, CanonicalParam
+from sourcepool import SourceServerGroup
+import stagememory
+from stagememory import StageMemory, StageClass, ResetPeakRss, PeakRss, RunChild, ResetChildPeak
+
+
+# stages run inside long-lived workers instead of `python <script>.py '<json>'`,
+# so that libotd, fontTools, the romanisation tables and source fonts stay loaded
+stageEntry = {
+    "merge": ("merge", "Merge"),
+    "set-encoding": ("set-encoding", "SetEncoding"),
+    "kern": ("kern", "Kern"),
+    "pack": ("pack", "Pack"),
+}
+
+# sources whose content is part of a stage's cache key
+stageScript = {
+    "merge": ["merge.py", "romanise.py", "pinyin.py", "pinyin.dat", "opencc_t2s.py", "otdfont.py", "otb.py", "outline.py", "budget.py", "configure.py"],
+    "set-encoding": ["set-encoding.py", "sfnt.py", "configure.py"],
+    "kern": ["kern.py", "sfnt.py", "configure.py"],
+    "pack": ["pack.py", "configure.py"],
+}
+libotdScript = sorted(glob.glob("libotd/**/*.py", recursive=True))
+
+
+class BuildError(Exception):
+    pass
+
+
+def ExpandVariable(text, variable):
+    for var, val in variable.items():
+        text = text.replace("${{{}}}".format(var), str(val))
+    return text
+
+
+def ExpandCommand(command, target, depend, variable):
+    command = ExpandVariable(command, variable)
+    command = command.replace("$@", target)
+    command = command.replace("$<", depend[0] if depend else "")
+    command = command.replace("$^", " ".join(depend))
+    return command
+
+
+def RunShell(command):
+    # returns the peak memory of the command in MiB
+    ignoreError = command.startswith("-")
+    if ignoreError:
+        command = command[1:]
+    ResetChildPeak()
+    code = RunChild(command, shell=True)
+    if code and not ignoreError:
+        raise BuildError("command failed with exit status {}: {}".format(code, command))
+    return stagememory.childPeak
+
+
+def RunStage(stage, param):
+    moduleName, functionName = stageEntry[stage]
+    module = importlib.import_module(moduleName)
+    getattr(module, functionName)(param)
+
+
+def RunRecipe(target, stage, command):
+    # returns the target, an error or None, and the peak memory in MiB
+    peak = None
+    try:
+        if stage:
+            directory = os.path.dirname(target)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            # workers are reused, the peak is only this job's after a reset
+            reset = ResetPeakRss()
+            ResetChildPeak()
+            RunStage(*stage)
+            peak = max(PeakRss(), stagememory.childPeak) if reset else None
+        else:
+            peak = max((RunShell(c) for c in command), default=None)
+    except Exception as e:
+        return target, "{}: {}".format(type(e).__name__, e), None
+    return target, None, peak
+
+
+class Builder:
+    def __init__(self, makefile, jobs=None, keepGoing=False, cache=None, skipOverBudget=False, memory=None, servers=None):
+        self.variable = makefile["variable"]
+        self.rule = {}
+        for target, recipe in makefile["rule"].items():
+            self.rule[ExpandVariable(target, self.variable)] = {
+                **recipe,
+                "depend": [ExpandVariable(dep, self.variable) for dep in recipe.get("depend", [])],
+            }
+        self.phony = set(self.rule.get(".PHONY", {}).get("depend", [])) | {"clean"}
+        self.jobs = jobs or os.cpu_count()
+        self.keepGoing = keepGoing
+        self.cache = cache
+        self.skipOverBudget = skipOverBudget
+        self.memory = memory
+        # source servers owned by the caller outlive the run, with their merged bases
+        self.servers = servers
+
+    def Depend(self, target):
+        return self.rule[target].get("depend", []) if target in self.rule else []
+
+    def Collect(self, goals):
+        graph = {}
+        stack = list(goals)
+        while stack:
+            target = stack.pop()
+            if target in graph:
+                continue
+            if target not in self.rule and not os.path.exists(target):
+                raise BuildError("no rule to make target '{}'".format(target))
+            graph[target] = self.Depend(target)
+            stack.extend(graph[target])
+        return graph
+
+    def IsOutdated(self, target):
+        if target in self.phony:
+            return True
+        if target not in self.rule:
+            return False
+        if not os.path.exists(target):
+            return True
+        mtime = os.stat(target).st_mtime_ns
+        for dep in self.Depend(target):
+            if dep in self.phony or not os.path.exists(dep) or os.stat(dep).st_mtime_ns > mtime:
+                return True
+        return False
+
+    def CacheKey(self, target):
+        # only intermediate and final fonts are worth caching, not pack copies
+        if not self.cache or not target.startswith("build/"):
+            return None
+        recipe = self.rule[target]
+        stage = recipe.get("stage")
+        if stage:
+            description = {"stage": stage[0], "param": CanonicalParam(stage[1])}
+            script = stageScript[stage[0]] + libotdScript
+        elif "instance" in recipe:
+            # an instance depends on its source and coordinates, not on the
+            # batch it happens to be built in
+            description = {"instance": recipe["instance"][target]}
+            script = ["instancer.js"]
+        else:
+            command = [ExpandVariable(c, self.variable) for c in recipe["command"]]
+            description = {"command": command}
+            if "output" in recipe:
+                # outputs of a grouped recipe share its command
+                description["output"] = target
+            script = [token for c in command for token in c.split()
+                      if token.endswith((".js", ".py")) and os.path.isfile(token)]
+        return self.cache.Key(description, recipe.get("depend", []), script)
+
+    def Restore(self, target):
+        # fetch `target` from the cache, if it is there
+        key = self.CacheKey(target)
+        if key and self.cache.Fetch(key, target):
+            print("[cache] {}".format(target), flush=True)
+            return True
+        return False
+
+    def Job(self, target, instance=None):
+        # `instance`: the outputs of a batched instancer recipe to make, all by default
+        recipe = self.rule[target]
+        stage = recipe.get("stage")
+        depend = recipe.get("depend", [])
+        command = recipe.get("command", [])
+        if instance is not None:
+            command = configure.InstancerCommand({o: recipe["instance"][o] for o in instance})
+        command = [ExpandCommand(c, target, depend, self.variable) for c in command]
+        return target, stage, command
+
+    def AtRisk(self, graph):
+        # targets whose merge is predicted to exceed the glyph limit, and everything built from them
+        budget = Budget()
+        plan = budget.Plan({target: self.rule[target] for target in graph if target in self.rule})
+        budget.Save()
+        over = OverBudget(plan)
+        for target in sorted(over):
+            print("build: warning: {} predicted at {} glyphs, over the limit".format(target, plan[target][0]), file=sys.stderr, flush=True)
+        dependent = {}
+        for target, depend in graph.items():
+            for dep in depend:
+                dependent.setdefault(dep, []).append(target)
+        atRisk = set()
+        stack = list(over)
+        while stack:
+            target = stack.pop()
+            if target in atRisk:
+                continue
+            atRisk.add(target)
+            stack.extend(dependent.get(target, []))
+        return over, atRisk
+
+    def Run(self, goals):
+        # romanisation fans out within a merge, its workers share the cores with the other jobs;
+        # set before anything is forked, so that every merge inherits it
+        os.environ["NOWAR_ROMANISE_JOBS"] = str(max(1, (os.cpu_count() or 1) // self.jobs))
+        graph = self.Collect(goals)
+        over, atRisk = self.AtRisk(graph)
+        dependent = {target: [] for target in graph}
+        waiting = {}
+        for target, depend in graph.items():
+            waiting[target] = len(depend)
+            for dep in depend:
+                dependent[dep].append(target)
+
+        ready = [target for target, count in waiting.items() if count == 0]
+        cacheKey = {}
+        admitted = {}
+        # grouped recipes being run, with the other outputs waiting for them
+        grouped = {}
+        finished = queue.Queue()
+        failed = []
+        running = 0
+
+        def complete(target):
+            for t in dependent[target]:
+                waiting[t] -= 1
+                if waiting[t] == 0:
+                    ready.append(t)
+
+        # merge jobs sharing a CJK source are forked from the same source server
+        # their resident sources and bases count against the memory budget
+        if self.servers:
+            servers = self.servers
+            servers.callback = finished.put
+            servers.Charge(self.memory)
+        else:
+            servers = SourceServerGroup(finished.put, max(1, self.jobs // 2), self.memory)
+
+        # targets at risk of the glyph limit go last, so that a failing merge does not hold back the rest;
+        # merges of one base run back to back, while their server still holds it
+        def locality(target):
+            stage = self.rule.get(target, {}).get("stage")
+            merge = bool(stage and stage[0] == "merge")
+            base = json.dumps(configure.BaseParam(stage[1]), sort_keys=True) if merge else ""
+            return (target not in atRisk, merge and servers.Has(stage[1]), base)
+
+        with multiprocessing.Pool(self.jobs) as pool:
+            try:
+                while ready or running:
+                    ready.sort(key=locality)
+                    deferred = []
+                    while ready and running < self.jobs:
+                        target = ready.pop()
+                        if not self.IsOutdated(target) or not self.rule.get(target, {}).get("command"):
+                            complete(target)
+                            continue
+                        if self.Restore(target):
+                            complete(target)
+                            continue
+                        key = self.CacheKey(target)
+                        group = tuple(self.rule[target].get("output", ()))
+                        if group in grouped:
+                            grouped[group].append(target)
+                            cacheKey[target] = key
+                            continue
+                        if self.skipOverBudget and target in over:
+                            # fails like a job would, without running it
+                            finished.put((target, "predicted over the glyph limit, skipped", None))
+                            admitted[target] = (None, 0)
+                            running += 1
+                            continue
+                        instance = None
+                        if "instance" in self.rule[target]:
+                            # instance only what is needed, neither up to date nor in the cache
+                            instance = [o for o in group if o == target or (o in graph and self.IsOutdated(o) and not self.Restore(o))]
+                        target, stage, command = self.Job(target, instance)
+                        cls = StageClass(stage, command)
+                        estimate = self.memory.Estimate(cls) if self.memory else 0
+                        if running and self.memory and not self.memory.Fits(estimate):
+                            # wait for memory; a smaller job may still fit
+                            deferred.append(target)
+                            continue
+                        if self.memory:
+                            self.memory.Acquire(estimate)
+                        admitted[target] = (cls, estimate)
+                        cacheKey[target] = key
+                        if group:
+                            grouped[group] = []
+                        print(("[{}] {}".format(stage[0], target)) if stage else "\n".join(command), flush=True)
+                        if stage and stage[0] == "merge":
+                            os.makedirs(os.path.dirname(target), exist_ok=True)
+                            servers.Submit(target, stage[1])
+                        else:
+                            pool.apply_async(RunRecipe, (target, stage, command), callback=finished.put)
+                        running += 1
+                    ready.extend(deferred)
+
+                    if not running:
+                        continue
+                    target, error, peak = finished.get()
+                    running -= 1
+                    cls, estimate = admitted.pop(target)
+                    if self.memory:
+                        self.memory.Release(estimate)
+                        if not error:
+                            self.memory.Record(cls, peak)
+                    sharing = grouped.pop(tuple(self.rule[target].get("output", ())), [])
+                    if error:
+                        print("build: *** [{}] {}".format(target, error), file=sys.stderr, flush=True)
+                        failed.extend([target] + sharing)
+                        if not self.keepGoing:
+                            pool.terminate()
+                            break
+                    else:
+                        for t in [target] + sharing:
+                            if cacheKey[t]:
+                                self.cache.Publish(cacheKey[t], t)
+                            complete(t)
+            finally:
+                if not self.servers:
+                    servers.Close()
+
+        if self.cache:
+            self.cache.Save()
+        if self.memory:
+            self.memory.Save()
+        if failed:
+            raise BuildError("{} target(s) failed".format(len(failed)))
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build Nowar fonts in long-lived worker processes")
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("-k", "--keep-going", action="store_true")
+    parser.add_argument("--cache-dir", default=os.environ.get("NOWAR_BUILD_CACHE", "build/cache"),
+                        help="content-addressed cache, may be shared between machines")
+    parser.add_argument("--no-cache", action="store_true")
+    parser.add_argument("--skip-over-budget", action="store_true",
+                        help="fail merges predicted over the glyph limit without running them")
+    parser.add_argument("--memory", type=float, default=os.environ.get("NOWAR_BUILD_MEMORY"),
+                        help="memory budget of concurrent jobs in GiB, 80%% of physical memory by default; 0 disables")
+    parser.add_argument("goal", nargs="*", default=["all"])
+    args = parser.parse_args()
+
+    cache = None if args.no_cache else BuildCache(args.cache_dir)
+    budget = args.memory
+    if budget is None:
+        physical = configure.PhysicalMemory()
+        budget = physical * 0.8 / 2 ** 30 if physical else 0
+    memory = StageMemory(float(budget) * 1024) if float(budget) > 0 else None
+    builder = Builder(configure.GenerateMakefile(), jobs=args.jobs, keepGoing=args.keep_going, cache=cache,
+                      skipOverBudget=args.skip_over_budget, memory=memory)
+    try:
+        builder.Run(args.goal)
+    except BuildError as e:
+        print("build: *** {}".format(e), file=sys.stderr)
+        sys.exit(2)
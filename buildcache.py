@@ -0,0 +1,110 @@
+import os
+import json
+import shutil
+import hashlib
+import tempfile
+
+
+# bump to invalidate every cached object, e.g. when a tool in the pipeline is upgraded
+cacheVersion = 1
+
+# mode of files written through a temporary file, which `mkstemp` creates
+# 0600; read once, the umask cannot be queried without setting it
+umask = os.umask(0)
+os.umask(umask)
+fileMode = 0o666 & ~umask
+
+
+def CopyFile(source, target):
+    # copy through a temporary file, so that `target` is either the old file
+    # or the complete new one, with the mode of a file created as usual
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(target) or ".")
+    os.close(fd)
+    try:
+        shutil.copyfile(source, tmp)
+        os.chmod(tmp, fileMode)
+        os.replace(tmp, target)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+def CanonicalParam(param):
+    if "feature" in param:
+        param = {**param, "feature": sorted(param["feature"])}
+    return json.dumps(param, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+
+
+class BuildCache:
+    def __init__(self, root="build/cache", statFile="build/digest.json"):
+        # digests are remembered by mtime and size locally, `root` may be shared
+        self.root = root
+        self.statFile = statFile
+        self.digest = {}
+        try:
+            with open(self.statFile) as f:
+                self.digest = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.dirty = False
+
+    def Digest(self, filename):
+        stat = os.stat(filename)
+        key = "{}:{}".format(stat.st_mtime_ns, stat.st_size)
+        known = self.digest.get(filename)
+        if known and known[0] == key:
+            return known[1]
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digest = h.hexdigest()
+        self.digest[filename] = (key, digest)
+        self.dirty = True
+        return digest
+
+    def Key(self, description, inputs, scripts):
+        h = hashlib.sha256()
+        h.update(json.dumps({
+            "version": cacheVersion,
+            "description": description,
+            "input": [self.Digest(f) for f in inputs],
+            "script": {f: self.Digest(f) for f in sorted(scripts)},
+        }, sort_keys=True, ensure_ascii=False).encode())
+        return h.hexdigest()
+
+    def ObjectPath(self, key):
+        return os.path.join(self.root, "objects", key[:2], key)
+
+    def Fetch(self, key, target):
+        obj = self.ObjectPath(key)
+        if not os.path.exists(obj):
+            return False
+        os.makedirs(os.path.dirname(target) or ".", exist_ok=True)
+        # an interrupted fetch must not leave a truncated target that looks
+        # up to date, nor change a target a running stage reads
+        try:
+            CopyFile(obj, target)
+        except FileNotFoundError:
+            # evicted by a concurrent build
+            return False
+        return True
+
+    def Publish(self, key, target):
+        obj = self.ObjectPath(key)
+        if os.path.exists(obj) or not os.path.exists(target):
+            return
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        # publish atomically, the cache may be shared between concurrent builds
+        CopyFile(target, obj)
+
+    def Save(self):
+        if not self.dirty:
+            return
+        directory = os.path.dirname(self.statFile) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.digest, f)
+        os.replace(tmp, self.statFile)
+        self.dirty = False
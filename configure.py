@@ -1,3 +1,5 @@
+import os
+import sys
 import json
 import codecs
 import enum
@@ -235,6 +237,11 @@ def AxisMapNotoWdth(wdth: float) -> float:
     return 0
 
 
+# weights fonts can be built in, bounded by the CJK source; lower weights
+# would map to its lightest master
+weightRange = (200, 900)
+
+
 def AxisMapShsWght(wght: float) -> float:
     # map user value to normalized design space.
     # adjusted to match our definition for Noto Sans
@@ -424,6 +431,17 @@ def ResolveDependency(p):
     return result
 
 
+# features applied over a shared merged base.
+# the feature powerset of a pack region and weight differs only in these,
+# so its variants cost one base merge plus small copy-on-write deltas.
+variantFeature = ["OSF", "SC", "RP", "CyR"]
+
+
+def BaseParam(p):
+    feature = [fea for fea in p["feature"] if fea not in variantFeature]
+    return {**p, "feature": feature, "encoding": "unspec"}
+
+
 def AcceptXmod(region, pinyin=False, romaja=False, pSimp=[]):
     xfea = []
     for mod, params in regionalVariant[region].get("xmod", []):
@@ -609,7 +627,20 @@ def ParamToArgument(param):
     return "'{}'".format(js)
 
 
-if __name__ == "__main__":
+# worker threads of a batched instancer.js, each with its own 2 GiB heap
+instancerJobs = 4
+
+
+def InstancerCommand(batch):
+    # commands making `batch`, {output: instance}, from the variable font `$<`
+    output = sorted(batch)
+    return [
+        "mkdir -p {}".format(" ".join(sorted({os.path.dirname(o) + "/" for o in output}))),
+        f"node --max-old-space-size=2048 instancer.js {ParamToArgument({'input': '$<', 'batch': [{'instance': batch[o], 'output': o} for o in output], 'jobs': instancerJobs})}",
+    ]
+
+
+def GenerateMakefile():
     makefile = {
         "variable": {
             "VERSION": config.version,
@@ -640,7 +671,6 @@ if __name__ == "__main__":
                                      [subset + [x] for subset in result], lst, [[]])
 
     finalOtfDeps = set()
-    nowarOtdDeps = set()
 
     # font pack for each regional variant and weight
     for r, w, fea in product(config.fontPackRegion, config.fontPackWeight, powerset(config.fontPackFeature)):
@@ -700,24 +730,22 @@ if __name__ == "__main__":
 
         finalOtfDeps.update(map(json.dumps, fontlist.values()))
 
+        # fonts are linked from a content-addressed store, see `pack.py`
+        member = {"Fonts/{}.ttf".format(f): "build/final-otf/{}.otf".format(GenerateFilename(p)) for f, p in fontlist.items()}
+        member["Fonts/LICENSE.txt"] = "LICENSE.txt"
+        packParam = {
+            "directory": f"out/{target}",
+            "archive": "out/DragonflightSans-{}-{}.7z".format(target, config.version),
+            "member": member,
+        }
         makefile["rule"][pack] = {
-            "depend": ["out/{}/Fonts/{}.ttf".format(target, f) for f in fontlist],
+            "depend": sorted(set(member.values())),
             "command": [
-                f"cd out/{target};" +
-                "cp ../../LICENSE.txt Fonts/LICENSE.txt;" +
-                "7z a -t7z -m0=LZMA:d=512m:fb=273 -ms ../../$@ Fonts/"
-            ]
+                "python pack.py {}".format(ParamToArgument(packParam)),
+            ],
+            "stage": ("pack", packParam),
         }
 
-        for f, p in fontlist.items():
-            makefile["rule"]["out/{}/Fonts/{}.ttf".format(target, f)] = {
-                "depend": ["build/final-otf/{}.otf".format(GenerateFilename(p))],
-                "command": [
-                    "mkdir -p out/{}/Fonts".format(target),
-                    "cp $^ $@",
-                ]
-            }
-
     # font files for Global Font addon
     for w, (e, r, fea, wd) in product(config.globalFontWeight, config.globalFontInstance):
         param = {
@@ -764,8 +792,44 @@ if __name__ == "__main__":
             ]
         }
 
-    # resolve deps -- final otf
+    ResolveFinalOtf(makefile, finalOtfDeps)
+    return makefile
+
+
+def FontMakefile(params):
+    # rules for just the final fonts of `params`, which need not be configured
+    makefile = {
+        "variable": {
+            "VERSION": config.version,
+        },
+        "rule": {},
+    }
+    ResolveFinalOtf(makefile, {json.dumps(p) for p in params})
+    return makefile
+
+
+def ResolveFinalOtf(makefile, finalOtfDeps):
+    # add the rules of `build/final-otf/*.otf` for each param in `finalOtfDeps`
+    # (JSON strings), and of everything they are built from
+    nowarOtdDeps = set()
+
+    # resolve deps -- encoding variants, patched from the final `unspec` font
+    unspecOtfDeps = set()
     for param in finalOtfDeps:
+        param = json.loads(param)
+        if param["encoding"] == "unspec":
+            unspecOtfDeps.add(json.dumps(param))
+        else:
+            unspec = {**param, "encoding": "unspec"}
+            unspecOtfDeps.add(json.dumps(unspec))
+            makefile["rule"]["build/final-otf/{}.otf".format(GenerateFilename(param))] = {
+                "depend": ["build/final-otf/{}.otf".format(GenerateFilename(unspec))],
+                "command": ["python set-encoding.py {}".format(ParamToArgument(param))],
+                "stage": ("set-encoding", param),
+            }
+
+    # resolve deps -- final otf
+    for param in unspecOtfDeps:
         param = json.loads(param)
         makefile["rule"]["build/final-otf/{}.otf".format(GenerateFilename(param))] = {
             "depend": ["build/unkerned-otf/{}.otf".format(GenerateFilename(param))],
@@ -773,29 +837,23 @@ if __name__ == "__main__":
                 "mkdir -p build/final-otf/",
                 "python kern.py {}".format(ParamToArgument(param)),
             ],
+            "stage": ("kern", param),
         }
         makefile["rule"]["build/unkerned-otf/{}.otf".format(GenerateFilename(param))] = {
-            "depend": ["build/otd/{}.otz".format(GenerateFilename(param))],
+            "depend": ["build/otd/{}.otb".format(GenerateFilename(param))],
             "command": [
                 "mkdir -p build/unkerned-otf/",
-                "zstd -d $< --stdout | otfccbuild -q -O3 --keep-average-char-width -o $@",
+                "python otb.py $< - | otfccbuild -q -O3 --keep-average-char-width -o $@",
             ],
         }
-        if param["encoding"] == "unspec":
-            nowarOtdDeps.add(json.dumps(param))
-        else:
-            unspec = {**param, "encoding": "unspec"}
-            nowarOtdDeps.add(json.dumps(unspec))
-            makefile["rule"]["build/otd/{}.otz".format(GenerateFilename(param))] = {
-                "depend": ["build/otd/{}.otz".format(GenerateFilename(unspec))],
-                "command": ["python set-encoding.py {}".format(ParamToArgument(param))]
-            }
+        nowarOtdDeps.add(json.dumps(param))
 
     # resolve deps -- nowar otd
+    instance = {}
     for param in nowarOtdDeps:
         param = json.loads(param)
         dep = ResolveDependency(param)
-        makefile["rule"]["build/otd/{}.otz".format(GenerateFilename(param))] = {
+        makefile["rule"]["build/otd/{}.otb".format(GenerateFilename(param))] = {
             "depend": [
                 "build/noto/{}.otz".format(GenerateFilename(dep["Latin"])),
                 "build/shs/{}.otz".format(
@@ -810,7 +868,8 @@ if __name__ == "__main__":
             "command": [
                 "mkdir -p build/otd/",
                 "python merge.py {}".format(ParamToArgument(param))
-            ]
+            ],
+            "stage": ("merge", param),
         }
 
         makefile["rule"][f"build/noto/{GenerateFilename(dep['Latin'])}.otz"] = {
@@ -821,13 +880,7 @@ if __name__ == "__main__":
         }
         notoInstance = [['wght', AxisMapNotoWgth(dep['Latin']['weight'])],
                         ['wdth', AxisMapNotoWdth(dep['Latin']['width'])]]
-        makefile["rule"][f"build/noto/{GenerateFilename(dep['Latin'])}.otf"] = {
-            "depend": [f"source/noto/NotoSans-VF.otf"],
-            "command": [
-                "mkdir -p build/noto/",
-                f"node --max-old-space-size=2048 instancer.js {ParamToArgument({'input': '$<', 'output': '$@', 'instance': notoInstance})}",
-            ]
-        }
+        instance.setdefault("source/noto/NotoSans-VF.otf", {})[f"build/noto/{GenerateFilename(dep['Latin'])}.otf"] = notoInstance
 
         if "Numeral" in dep:
             makefile["rule"][f"build/noto/{GenerateFilename(dep['Numeral'])}.otz"] = {
@@ -838,13 +891,7 @@ if __name__ == "__main__":
             }
             notoInstance = [['wght', AxisMapNotoWgth(dep['Numeral']['weight'])],
                             ['wdth', AxisMapNotoWdth(dep['Numeral']['width'])]]
-            makefile["rule"][f"build/noto/{GenerateFilename(dep['Numeral'])}.otf"] = {
-                "depend": [f"source/noto/NotoSans-VF.otf"],
-                "command": [
-                    "mkdir -p build/noto/",
-                    f"node --max-old-space-size=2048 instancer.js {ParamToArgument({'input': '$<', 'output': '$@', 'instance': notoInstance})}",
-                ]
-            }
+            instance.setdefault("source/noto/NotoSans-VF.otf", {})[f"build/noto/{GenerateFilename(dep['Numeral'])}.otf"] = notoInstance
 
         if "Roman" in dep:
             makefile["rule"][f"build/roman/{GenerateFilename(dep['Roman'])}.otz"] = {
@@ -856,13 +903,7 @@ if __name__ == "__main__":
             }
             notoInstance = [['wght', AxisMapNotoWgth(dep['Roman']['weight'])],
                             ['wdth', AxisMapNotoWdth(dep['Roman']['width'])]]
-            makefile["rule"][f"build/noto/{GenerateFilename(dep['Roman'])}.otf"] = {
-                "depend": [f"source/noto/NotoSans-VF.otf"],
-                "command": [
-                    "mkdir -p build/noto/",
-                    f"node --max-old-space-size=2048 instancer.js {ParamToArgument({'input': '$<', 'output': '$@', 'instance': notoInstance})}",
-                ]
-            }
+            instance.setdefault("source/noto/NotoSans-VF.otf", {})[f"build/noto/{GenerateFilename(dep['Roman'])}.otf"] = notoInstance
 
         makefile["rule"][f"build/shs/{GenerateFilename(dep['CJK'])}.otz"] = {
             "depend": [f"build/shs/{GenerateFilename(dep['CJK'])}.otf"],
@@ -871,14 +912,25 @@ if __name__ == "__main__":
             ]
         }
         shsInstance = [['wght', AxisMapShsWght(dep['CJK']['weight'])]]
-        makefile["rule"][f"build/shs/{GenerateFilename(dep['CJK'])}.otf"] = {
-            "depend": [f"source/shs/{dep['CJK']['region']}-VF.otf"],
-            "command": [
-                "mkdir -p build/shs/",
-                f"node --max-old-space-size=2048 instancer.js {ParamToArgument({'input': '$<', 'output': '$@', 'instance': shsInstance})}",
-            ]
+        instance.setdefault(f"source/shs/{dep['CJK']['region']}-VF.otf", {})[f"build/shs/{GenerateFilename(dep['CJK'])}.otf"] = shsInstance
+
+    # resolve deps -- instances, all of one source in a single batch,
+    # so the variable font is read once.
+    # grouped outputs share one recipe, listed in its "output"; the build
+    # driver instances only the outputs it needs, by their "instance"
+    for source, batch in instance.items():
+        output = sorted(batch)
+        recipe = {
+            "depend": [source],
+            "output": output,
+            "instance": batch,
+            "command": InstancerCommand(batch),
         }
+        for o in output:
+            makefile["rule"][o] = recipe
+
 
+def DumpMakefile(makefile):
     # dump `makefile` dict to actual “GNU Makefile”
     makedump = ""
 
@@ -887,10 +939,113 @@ if __name__ == "__main__":
 
     for tar, recipe in makefile["rule"].items():
         dep = recipe["depend"] if "depend" in recipe else []
-        makedump += "{}: {}\n".format(tar, " ".join(dep))
+        if "output" in recipe:
+            # grouped targets, GNU Make 4.3
+            if tar != recipe["output"][0]:
+                continue
+            makedump += "{} &: {}\n".format(" ".join(recipe["output"]), " ".join(dep))
+        else:
+            makedump += "{}: {}\n".format(tar, " ".join(dep))
         com = recipe["command"] if "command" in recipe else []
         for c in com:
             makedump += "\t{}\n".format(c)
 
     with codecs.open("Makefile", 'w', 'UTF-8') as mf:
         mf.write(makedump)
+
+
+# ninja pools by memory class: a command matching a pattern runs in the
+# pool, with as many jobs at once as fit the machine's memory
+ninjaPool = [
+    # (pool, command pattern, GiB per job)
+    ("instancer", "instancer.js", 2.5 * instancerJobs),
+    ("merge", "merge.py", 4),
+    ("otfcc", "otfcc", 3),
+    ("pack", "pack.py", 6),  # 7z with a 512 MiB dictionary
+]
+
+
+def NinjaEscapePath(path):
+    return path.replace("$", "$$").replace(" ", "$ ").replace(":", "$:")
+
+
+def PhysicalMemory():
+    # in bytes, or None where the platform does not tell
+    try:
+        return os.sysconf("SC_PAGE_SIZE") * os.sysconf("SC_PHYS_PAGES")
+    except (ValueError, OSError, AttributeError):
+        return None
+
+
+def NinjaPoolDepth(gib):
+    memory = PhysicalMemory()
+    if memory is None:
+        return 1
+    return max(1, int(memory / (gib * 2 ** 30)))
+
+
+def DumpNinja(makefile):
+    # dump `makefile` dict to “build.ninja”.
+    # one generic rule runs each edge's own command; ninja creates output
+    # directories itself, so `mkdir -p` is dropped. python scripts run under
+    # `depfile.py` and report the modules they import.
+    def expand(text):
+        for var, val in makefile["variable"].items():
+            text = text.replace("${{{}}}".format(var), str(val))
+        return text
+
+    ninja = "ninja_required_version = 1.10\n\n"
+    for pool, _, gib in ninjaPool:
+        ninja += "pool {}\n  depth = {}\n\n".format(pool, NinjaPoolDepth(gib))
+    ninja += "rule run\n  command = $cmd\n  description = $desc\n  restat = 1\n\n"
+    ninja += "rule run-dep\n  command = $cmd\n  description = $desc\n  restat = 1\n  depfile = $out.d\n  deps = gcc\n\n"
+    ninja += "rule configure\n  command = python configure.py ninja\n  generator = 1\n\n"
+    ninja += "build build.ninja: configure configure.py\n\n"
+
+    for tar, recipe in makefile["rule"].items():
+        if tar == ".PHONY":
+            continue
+        if "output" in recipe and tar != recipe["output"][0]:
+            continue
+        tar = expand(tar)
+        dep = [expand(d) for d in recipe.get("depend", [])]
+        out = " ".join(NinjaEscapePath(expand(o)) for o in recipe.get("output", [tar]))
+        com = [c for c in recipe.get("command", []) if not c.startswith("mkdir -p ")]
+        if not com:
+            ninja += "build {}: phony {}\n".format(out, " ".join(map(NinjaEscapePath, dep)))
+            continue
+
+        depfile = False
+        command = []
+        for c in com:
+            c = expand(c)
+            if c.startswith("-"):
+                c = "{} || true".format(c[1:])
+            if c.startswith("python ") and c.split()[1].endswith(".py") and not depfile:
+                c = "python depfile.py $@.d $@ {}".format(c[len("python "):])
+                depfile = True
+            c = c.replace("$", "$$")
+            c = c.replace("$$@", "$out").replace("$$^", "$in")
+            c = c.replace("$$<", NinjaEscapePath(dep[0]) if dep else "")
+            command.append(c)
+        command = " && ".join(command)
+
+        ninja += "build {}: {} {}\n".format(out, "run-dep" if depfile else "run", " ".join(map(NinjaEscapePath, dep)))
+        ninja += "  cmd = {}\n".format(command)
+        ninja += "  desc = {}\n".format(NinjaEscapePath(tar))
+        for pool, pattern, _ in ninjaPool:
+            if pattern in command:
+                ninja += "  pool = {}\n".format(pool)
+                break
+
+    ninja += "\ndefault all\n"
+    with codecs.open("build.ninja", 'w', 'UTF-8') as nf:
+        nf.write(ninja)
+
+
+if __name__ == "__main__":
+    # usage: python configure.py [ninja]
+    if sys.argv[1:] == ["ninja"]:
+        DumpNinja(GenerateMakefile())
+    else:
+        DumpMakefile(GenerateMakefile())
@@ -0,0 +1,48 @@
+import os
+import sys
+import runpy
+
+
+# run a build script and record the sources it read in a Makefile-style
+# depfile, so that ninja rebuilds its outputs when any of them changes.
+#
+# usage: python depfile.py <depfile> <target> <script> [args...]
+#
+# the sources are the repository modules the script imported, and the data
+# files they declare in a module-level `dataFile`.
+root = os.path.dirname(os.path.abspath(__file__))
+
+
+def LoadedSources(script):
+    sources = {os.path.relpath(os.path.abspath(script), root)}
+    for module in list(sys.modules.values()):
+        for filename in (getattr(module, "__file__", None), getattr(module, "dataFile", None)):
+            if not isinstance(filename, str):
+                continue
+            filename = os.path.abspath(filename)
+            if filename.startswith(root + os.sep) and os.path.isfile(filename):
+                sources.add(os.path.relpath(filename, root))
+    return sorted(sources)
+
+
+def Escape(path):
+    return path.replace("\\", "\\\\").replace(" ", "\\ ").replace("$", "$$")
+
+
+def WriteDepfile(filename, target, sources):
+    tmp = filename + ".tmp"
+    with open(tmp, 'w') as f:
+        f.write("{}: {}\n".format(Escape(target), " ".join(map(Escape, sources))))
+    os.replace(tmp, filename)
+
+
+if __name__ == "__main__":
+    depfile, target, script = sys.argv[1:4]
+    sys.argv = [script] + sys.argv[4:]
+    try:
+        runpy.run_path(script, run_name="__main__")
+    except SystemExit as e:
+        if e.code:
+            raise
+    sys.stdout.flush()
+    WriteDepfile(depfile, target, LoadedSources(script))
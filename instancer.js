@@ -1,15 +1,9 @@
 "use strict";
 
 const fs = require("fs");
+const { Worker, isMainThread, workerData } = require("worker_threads");
 const { FontIo, Ot, Rectify } = require("ot-builder");
 
-function readOtf(filename) {
-	const otfBuf = fs.readFileSync(filename);
-	const sfnt = FontIo.readSfntOtf(otfBuf);
-	const font = FontIo.readFont(sfnt, Ot.ListGlyphStoreFactory);
-	return font;
-}
-
 function writeOtf(font, filename) {
 	const sfnt = FontIo.writeFont(font);
 	const otfBuf = FontIo.writeSfntOtf(sfnt);
@@ -47,8 +41,83 @@ function instanceFont(font, parameters) {
 	convertToCff1(font);
 }
 
-const args = JSON.parse(process.argv[2]);
+// a copy of the object graph under `root`, with shared objects shared in the
+// copy as well, so that glyphs referenced from several tables stay one glyph
+function cloneGraph(root) {
+	const copies = new Map();
+	const clone = x => {
+		if (x === null || typeof x !== "object") return x;
+		if (copies.has(x)) return copies.get(x);
+		let c;
+		if (x instanceof ArrayBuffer) {
+			c = x.slice(0);
+		} else if (ArrayBuffer.isView(x) && !(x instanceof DataView)) {
+			// %TypedArray%.prototype.slice copies, Buffer.prototype.slice would not
+			c = Object.getPrototypeOf(Uint8Array.prototype).slice.call(x);
+		} else if (x instanceof Map) {
+			c = new Map();
+			copies.set(x, c);
+			for (const [k, v] of x) c.set(clone(k), clone(v));
+			return c;
+		} else if (x instanceof Set) {
+			c = new Set();
+			copies.set(x, c);
+			for (const v of x) c.add(clone(v));
+			return c;
+		} else {
+			c = Array.isArray(x) ? new Array(x.length) : Object.create(Object.getPrototypeOf(x));
+			copies.set(x, c);
+			for (const key of Reflect.ownKeys(x)) {
+				const desc = Object.getOwnPropertyDescriptor(x, key);
+				if ("value" in desc) desc.value = clone(desc.value);
+				Object.defineProperty(c, key, desc);
+			}
+			return c;
+		}
+		copies.set(x, c);
+		return c;
+	};
+	return clone(root);
+}
 
-const font = readOtf(args.input);
-instanceFont(font, args.instance);
-writeOtf(font, args.output);
+function instanceBatch(otfBuf, batch) {
+	// decoding the variable font costs more than instancing it, so it is
+	// decoded once; instancing rewrites the font in place, so every instance
+	// but the last works on a copy
+	const font = FontIo.readFont(FontIo.readSfntOtf(otfBuf), Ot.ListGlyphStoreFactory);
+	batch.forEach(({ instance, output }, i) => {
+		const target = i === batch.length - 1 ? font : cloneGraph(font);
+		instanceFont(target, instance);
+		writeOtf(target, output);
+	});
+}
+
+// arguments: { input, instance, output }, or { input, batch: [{ instance, output }], jobs }
+// for many instances of one source, written by up to `jobs` worker threads
+if (isMainThread) {
+	const args = JSON.parse(process.argv[2]);
+	const batch = args.batch || [{ instance: args.instance, output: args.output }];
+	const jobs = Math.max(1, Math.min(args.jobs || 1, batch.length));
+	const otfBuf = fs.readFileSync(args.input);
+	if (jobs === 1) {
+		instanceBatch(otfBuf, batch);
+	} else {
+		const shared = new Uint8Array(new SharedArrayBuffer(otfBuf.length));
+		shared.set(otfBuf);
+		for (let i = 0; i < jobs; i++) {
+			const worker = new Worker(__filename, {
+				workerData: { buf: shared, batch: batch.filter((_, j) => j % jobs === i) },
+				resourceLimits: { maxOldGenerationSizeMb: 2048 }
+			});
+			worker.on("error", e => {
+				console.error(e);
+				process.exitCode = 1;
+			});
+			worker.on("exit", code => {
+				if (code) process.exitCode = 1;
+			});
+		}
+	}
+} else {
+	instanceBatch(Buffer.from(workerData.buf.buffer), workerData.batch);
+}
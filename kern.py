@@ -1,86 +1,192 @@
+import os
 import sys
 import json
+import struct
+import hashlib
+from array import array
 import configure
 
-from fontTools.ttLib import TTFont, newTable
-from fontTools.ttLib.tables._k_e_r_n import KernTable_format_0
+import numpy as np
 
+from sfnt import ReadCmap, BuildKernTable, SetTable
 
-def BuildGenericKernSubtable(font, cyrillic):
-	scriptDflt = [ scr for scr in font['GPOS'].table.ScriptList.ScriptRecord if scr.ScriptTag == 'DFLT' ]
-	scriptDfltFeaList = [ font['GPOS'].table.FeatureList.FeatureRecord[i] for i in scriptDflt[0].Script.DefaultLangSys.FeatureIndex ]
+
+# letters in Adobe Latin 1 and Adobe Cyrillic 1
+kernSubsetLatin = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyzÀÁÂÃÄÅÆÇÈÉÊËÌÍÎÏÐÑÒÓÔÕÖØÙÚÛÜÝÞßàáâãäåæçèéêëìíîïðñòóôõöøùúûüýþÿıŁłŒœŠšŸŽžƒ"
+kernSubsetCyrillic = "ЀЁЂЃЄЅІЇЈЉЊЋЌЍЎЏАБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдежзийклмнопрстуфхцчшщъыьэюяѐёђѓєѕіїјљњћќѝўџѢѣѲѳѴѵҐґ"
+
+
+def GetKernLookups(font):
+	gpos = font['GPOS'].table
+	scriptDflt = [ scr for scr in gpos.ScriptList.ScriptRecord if scr.ScriptTag == 'DFLT' ]
+	scriptDfltFeaList = [ gpos.FeatureList.FeatureRecord[i] for i in scriptDflt[0].Script.DefaultLangSys.FeatureIndex ]
 	kernFeaList = [ fea.Feature for fea in scriptDfltFeaList if fea.FeatureTag == 'kern' ]
-	kernLutList = [ font['GPOS'].table.LookupList.Lookup[i] for fea in kernFeaList for i in fea.LookupListIndex ]
+	kernLutIndex = sorted({ i for fea in kernFeaList for i in fea.LookupListIndex })
+
+	kernLookups = []
+	for i in kernLutIndex:
+		lut = gpos.LookupList.Lookup[i]
+		if lut.LookupType == 2:
+			kernLookups.append(lut.SubTable)
+		elif lut.LookupType == 9:
+			kernLookups.append([ st.ExtSubTable for st in lut.SubTable if st.ExtensionLookupType == 2 ])
+	return kernLookups
 
-	kernPairStList = sum([ lut.SubTable for lut in kernLutList if lut.LookupType == 2 ], [])
-	kernExtLutList = sum([ lut.SubTable for lut in kernLutList if lut.LookupType == 9 ], [])
-	kernPairStList += [ lut.ExtSubTable for lut in kernExtLutList if lut.ExtensionLookupType == 2 ]
 
-	# letters in Adobe Latin 1 and Adobe Cyrillic 1
-	kernSubset = "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyzÀÁÂÃÄÅÆÇÈÉÊËÌÍÎÏÐÑÒÓÔÕÖØÙÚÛÜÝÞßàáâãäåæçèéêëìíîïðñòóôõöøùúûüýþÿıŁłŒœŠšŸŽžƒ"
-	if cyrillic:
-		kernSubset += "ЀЁЂЃЄЅІЇЈЉЊЋЌЍЎЏАБВГДЕЖЗИЙКЛМНОПРСТУФХЦЧШЩЪЫЬЭЮЯабвгдежзийклмнопрстуфхцчшщъыьэюяѐёђѓєѕіїјљњћќѝўџѢѣѲѳѴѵҐґ"
+def XAdvance(value):
+	if value is None:
+		return 0
+	return getattr(value, 'XAdvance', 0) or 0
 
+
+def ExtractKernPairs(font, cyrillic):
+	kernSubset = kernSubsetLatin + (kernSubsetCyrillic if cyrillic else "")
 	cmap = font['cmap'].getBestCmap()
-	kernGlyph = {*[ cmap[ord(ch)] for ch in kernSubset ]}
-
-	kernPairs = {}
-
-	for st in kernPairStList:
-		if st.Format == 1:
-			coverage = st.Coverage.glyphs
-			for i in range(st.PairSetCount):
-				first = coverage[i]
-				if first not in kernGlyph:
-					continue
-				pairSet = st.PairSet[i]
-				for pairRec in pairSet.PairValueRecord:
-					second = pairRec.SecondGlyph
-					if second not in kernGlyph:
-						continue
-					value = pairRec.Value1.XAdvance
-					if value:
-						kernPairs[(first, second)] = value
-
-		elif st.Format == 2:
-			coverage = st.Coverage.glyphs
-			classDef1 = st.ClassDef1.classDefs
-			classDef2 = st.ClassDef2.classDefs
-			for first in coverage:
-				if first not in kernGlyph:
-					continue
-				firstClass = classDef1.get(first, 0)
-				class1Record = st.Class1Record[firstClass]
-				for second in coverage:
-					if second not in kernGlyph:
-						continue
-					secondClass = classDef2.get(second, 0)
-					class2Record = class1Record.Class2Record[secondClass]
-					value = class2Record.Value1.XAdvance
-					if value:
-						kernPairs[(first, second)] = value
-
-	subtable = KernTable_format_0()
-	subtable.coverage = 0b00000001
-	subtable.format = 0
-	subtable.kernTable = kernPairs
-	return subtable
-
-
-def BuildFuColonKernSubtable(font, left, right):
+	kernGlyph = sorted({ cmap[ord(ch)] for ch in kernSubset }, key=font.getGlyphID)
+	glyphIndex = { g: i for i, g in enumerate(kernGlyph) }
+	n = len(kernGlyph)
+
+	total = np.zeros((n, n), dtype=np.int32)
+	for subtables in GetKernLookups(font):
+		# within a lookup the first subtable matching a pair wins,
+		# values from different lookups accumulate
+		value = np.zeros((n, n), dtype=np.int32)
+		done = np.zeros((n, n), dtype=bool)
+		for st in subtables:
+			covered = [ glyphIndex[g] for g in st.Coverage.glyphs if g in glyphIndex ]
+			if not covered:
+				continue
+
+			if st.Format == 1:
+				coverageIndex = { g: i for i, g in enumerate(st.Coverage.glyphs) }
+				for first in covered:
+					pairSet = st.PairSet[coverageIndex[kernGlyph[first]]]
+					for pairRec in pairSet.PairValueRecord:
+						second = glyphIndex.get(pairRec.SecondGlyph)
+						if second is None or done[first, second]:
+							continue
+						value[first, second] = XAdvance(pairRec.Value1)
+						done[first, second] = True
+
+			elif st.Format == 2:
+				classDef1 = st.ClassDef1.classDefs if st.ClassDef1 else {}
+				classDef2 = st.ClassDef2.classDefs if st.ClassDef2 else {}
+				class1 = [ classDef1.get(kernGlyph[i], 0) for i in covered ]
+				class2 = np.array([ classDef2.get(g, 0) for g in kernGlyph ])
+				# value matrix of the first classes in use × all second classes
+				usedClass1 = sorted(set(class1))
+				matrix = np.array([
+					[ XAdvance(c2.Value1) for c2 in st.Class1Record[c1].Class2Record ]
+					for c1 in usedClass1
+				], dtype=np.int32).reshape(len(usedClass1), st.Class2Count)
+				covered = np.array(covered)
+				row = np.searchsorted(usedClass1, class1)
+				# a covered first glyph matches every second glyph, class 0 included
+				rows = matrix[row[:, None], class2[None, :]]
+				pending = ~done[covered]
+				value[covered] = np.where(pending, rows, value[covered])
+				done[covered] = True
+
+		total += value
+
+	firsts, seconds = np.nonzero(total)
+	return { (kernGlyph[i], kernGlyph[j]): int(total[i, j]) for i, j in zip(firsts, seconds) }
+
+
+# kern pairs by code point, cached per Latin instance.
+# the pairs depend only on the Noto instance, whether Cyrillic is kerned
+# and whether small caps are mapped, not on the rest of the merged font.
+kernCacheMagic = b"KPT\x01"
+kernCacheDirectory = "build/kern"
+kernCache = {}
+digestCache = {}
+
+
+def FileDigest(filename):
+	# content digest, remembered by mtime and size
+	stat = os.stat(filename)
+	key = (stat.st_mtime_ns, stat.st_size)
+	if digestCache.get(filename, (None,))[0] != key:
+		with open(filename, 'rb') as f:
+			digestCache[filename] = (key, hashlib.sha256(f.read()).hexdigest()[:24])
+	return digestCache[filename][1]
+
+
+def KernCachePath(param):
+	# keyed by the Latin source and by this script, which extracts the pairs
+	dep = configure.ResolveDependency(param)["Latin"]
+	digest = FileDigest("build/noto/{}.otf".format(configure.GenerateFilename(dep)))
+	code = FileDigest(os.path.abspath(__file__))[:8]
+	flags = [ "Cyrillic" ] if "CyR" not in param["feature"] else []
+	flags += [ "SC" ] if "SC" in param["feature"] else []
+	return "{}/{}.kpt".format(kernCacheDirectory, "-".join([ digest, code ] + flags))
+
+
+def WriteKernCache(filename, pairs):
+	first = array('I', [ p[0] for p in pairs ])
+	second = array('I', [ p[1] for p in pairs ])
+	value = array('h', [ p[2] for p in pairs ])
+	os.makedirs(os.path.dirname(filename), exist_ok=True)
+	tmp = "{}.{}.tmp".format(filename, os.getpid())
+	with open(tmp, 'wb') as f:
+		f.write(kernCacheMagic + struct.pack("<I", len(pairs)))
+		f.write(first.tobytes() + second.tobytes() + value.tobytes())
+	os.replace(tmp, filename)
+
+
+def ReadKernCache(filename):
+	with open(filename, 'rb') as f:
+		data = f.read()
+	if data[:4] != kernCacheMagic:
+		raise ValueError("{} is not a kern pair cache".format(filename))
+	count, = struct.unpack_from("<I", data, 4)
+	first, second, value = array('I'), array('I'), array('h')
+	first.frombytes(data[8:8 + 4 * count])
+	second.frombytes(data[8 + 4 * count:8 + 8 * count])
+	value.frombytes(data[8 + 8 * count:8 + 10 * count])
+	return list(zip(first, second, value))
+
+
+def CodePointKernPairs(font, cyrillic):
+	kernSubset = kernSubsetLatin + (kernSubsetCyrillic if cyrillic else "")
 	cmap = font['cmap'].getBestCmap()
+	glyphPairs = ExtractKernPairs(font, cyrillic)
+	return [
+		(ord(a), ord(b), glyphPairs[(cmap[ord(a)], cmap[ord(b)])])
+		for a in kernSubset for b in kernSubset
+		if (cmap[ord(a)], cmap[ord(b)]) in glyphPairs
+	]
+
+
+def LoadKernPairs(filename, param):
+	# the font is only parsed when the pairs are not cached yet
+	cacheFile = KernCachePath(param)
+	if cacheFile not in kernCache:
+		if os.path.exists(cacheFile):
+			kernCache[cacheFile] = ReadKernCache(cacheFile)
+		else:
+			# fontTools is only loaded here, on a miss
+			from fontTools.ttLib import TTFont
+			font = TTFont(filename, lazy=True)
+			kernCache[cacheFile] = CodePointKernPairs(font, "CyR" not in param["feature"])
+			font.close()
+			WriteKernCache(cacheFile, kernCache[cacheFile])
+	return kernCache[cacheFile]
+
+
+def BuildGenericKernSubtable(cmap, pairs):
+	# cmap: code point to glyph id, pairs: code point kern pairs
+	return { (cmap[a], cmap[b]): v for a, b, v in pairs }
+
+
+def BuildFuColonKernSubtable(cmap, left, right):
 	nums = [ cmap[ord(i)] for i in "0123456789" ]
 	fuColon = cmap[ord("：")]
 
 	kernPairs = {(fuColon, n): right for n in nums}
 	if left:
 		kernPairs.update({ (n, fuColon): right for n in nums })
-
-	subtable = KernTable_format_0()
-	subtable.coverage = 0b00000001
-	subtable.format = 0
-	subtable.kernTable = kernPairs
-	return subtable
+	return kernPairs
 
 
 fuColonKernValue = {
@@ -94,19 +200,24 @@ fuColonKernValue = {
 }
 
 
-if __name__ == "__main__":
-	param = sys.argv[1]
-	param = json.loads(param)
-
-	font = TTFont("build/unkerned-otf/{}.otf".format(configure.GenerateFilename(param)), recalcBBoxes=False, recalcTimestamp=False)
-
-	kern = newTable('kern')
-	kern.version = 0
-	kern.kernTables = [BuildGenericKernSubtable(font, "CyR" not in param["feature"])]
-	font['kern'] = kern
+def Kern(param):
+	# the `kern` table is built from glyph ids read straight from the binary
+	# `cmap` and spliced into the font, every other table is copied as is
+	filename = "build/unkerned-otf/{}.otf".format(configure.GenerateFilename(param))
+	with open(filename, 'rb') as f:
+		data = memoryview(f.read())
+	cmap = ReadCmap(data)
 
+	subtables = [BuildGenericKernSubtable(cmap, LoadKernPairs(filename, param))]
 	if "FuCK" in param["feature"]:
 		left, right = fuColonKernValue[param["region"]]
-		kern.kernTables.append(BuildFuColonKernSubtable(font, left, right))
+		subtables.append(BuildFuColonKernSubtable(cmap, left, right))
+
+	with open("build/final-otf/{}.otf".format(configure.GenerateFilename(param)), 'wb') as f:
+		f.write(SetTable(data, "kern", BuildKernTable(subtables)))
 
-	font.save("build/final-otf/{}.otf".format(configure.GenerateFilename(param)))
+
+if __name__ == "__main__":
+	param = sys.argv[1]
+	param = json.loads(param)
+	Kern(param)
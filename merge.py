@@ -1,16 +1,19 @@
 import sys
 import copy
 import json
+from array import array
 
-from libotd.rebase import Rebase
-from libotd.dereference import Dereference
 from libotd.merge import MergeBelow, MergeAbove
 from libotd.pkana import ApplyPalt, NowarApplyPaltMultiplied
-from libotd.transform import Transform, ChangeAdvanceWidth
+from libotd.transform import ChangeAdvanceWidth
 from libotd.gsub import GetGsubFlat, ApplyGsubSingle
 from libotd.gc import Gc, Consolidate, NowarRemoveFeatures
-from libotd.otz import ReadOtz, WriteOtz
 from romanise import BuildRomanisedFont
+from outline import Rebase, Dereference, TransformGlyphs
+from sourcepool import pool, SourcePath
+from otdfont import CowFont, CopyJson, RemapCmap, FontCmap, ExtractSubFont
+from otb import WriteOtb
+from budget import glyphLimit
 import configure
 
 
@@ -186,47 +189,62 @@ def NameFont(param, font):
         cff['weight'] = subfamily
 
 
-def GenerateAsianSymbolFont(font):
-    asianSymbol = [
-        0x00B7,  # MIDDLE DOT
-        0x2014,  # EM DASH
-        0x2015,  # HORIZONTAL BAR
-        0x2018,  # LEFT SINGLE QUOTATION MARK
-        0x2019,  # RIGHT SINGLE QUOTATION MARK
-        0x201C,  # LEFT DOUBLE QUOTATION MARK
-        0x201D,  # RIGHT DOUBLE QUOTATION MARK
-        0x2026,  # HORIZONTAL ELLIPSIS
-        0x2027,  # HYPHENATION POINT
-        0x2E3A,  # TWO-EM DASH
-        0x2E3B,  # THREE-EM DASH
-    ]
-    symbolFont = {}
-    symbolFont["cmap"] = {k: v for k,
-                          v in font["cmap"].items() if int(k) in asianSymbol}
-    glyphSet = {symbolFont["cmap"].values()}
-    symbolFont["glyf"] = {k: v for k,
-                          v in font["glyf"].items() if k in glyphSet}
-    symbolFont["glyph_order"] = ["symb.notdef"]
-    return symbolFont
+asianSymbol = [
+    0x00B7,  # MIDDLE DOT
+    0x2014,  # EM DASH
+    0x2015,  # HORIZONTAL BAR
+    0x2018,  # LEFT SINGLE QUOTATION MARK
+    0x2019,  # RIGHT SINGLE QUOTATION MARK
+    0x201C,  # LEFT DOUBLE QUOTATION MARK
+    0x201D,  # RIGHT DOUBLE QUOTATION MARK
+    0x2026,  # HORIZONTAL ELLIPSIS
+    0x2027,  # HYPHENATION POINT
+    0x2E3A,  # TWO-EM DASH
+    0x2E3B,  # THREE-EM DASH
+]
+
+# symbol fonts by the source instance they were extracted from
+symbolFontCache = {}
+
+
+def GenerateAsianSymbolFont(font, key=None):
+    symbolFont = symbolFontCache.get(key) if key else None
+    if symbolFont is None:
+        symbolFont = ExtractSubFont(font, asianSymbol)
+        if key:
+            symbolFontCache[key] = symbolFont
+    # the caller merges it, hand out a copy
+    return {
+        "cmap": symbolFont["cmap"].Copy(),
+        "glyf": CopyJson(symbolFont["glyf"]),
+        "glyph_order": ["symb.notdef"],
+    }
+
+
+# OpenCC T2S as parallel code point arrays, built once per process
+t2sIndex = None
+
+
+def T2sIndex():
+    global t2sIndex
+    if t2sIndex is None:
+        from opencc_t2s import OpenCC_T2S
+        t2sIndex = (
+            array('I', map(ord, OpenCC_T2S.keys())),
+            array('I', map(ord, OpenCC_T2S.values())),
+        )
+    return t2sIndex
 
 
 def Simplify(font):
-    from opencc_t2s import OpenCC_T2S
-    cmap = asianFont['cmap']
-    for t, s in OpenCC_T2S.items():
-        us = str(ord(s))
-        if us in cmap:
-            ut = str(ord(t))
-            cmap[ut] = cmap[us]
-
+    # map traditional code points to the glyphs of their simplified forms
+    RemapCmap(font, *T2sIndex())
 
-if __name__ == '__main__':
-    param = sys.argv[1]
-    param = json.loads(param)
 
+def MergeBase(param):
     dep = configure.ResolveDependency(param)
 
-    baseFont = ReadOtz(f"build/noto/{configure.GenerateFilename(dep['Latin'])}.otz")
+    baseFont = pool.View(SourcePath("Latin", dep["Latin"]))
     upm = baseFont["head"]["unitsPerEm"]
     if (upm != 1000):
         Rebase(baseFont, 1000 / upm, roundToInt=True)
@@ -246,18 +264,9 @@ if __name__ == '__main__':
     os_2['usWinAscent'] = 1050
     os_2['usWinDescent'] = 300
 
-    # oldstyle figure
-    if "OSF" in param["feature"]:
-        ApplyGsubSingle('pnum', baseFont)
-        ApplyGsubSingle('onum', baseFont)
-
-    # small caps
-    if "SC" in param["feature"]:
-        ApplyGsubSingle('smcp', baseFont)
-
     # Warcraft numeral hack
     if param["width"] == 10:
-        numFont = ReadOtz(f"build/noto/{configure.GenerateFilename(dep['Numeral'])}.otz")
+        numFont = pool.View(SourcePath("Numeral", dep["Numeral"]))
         if (upm != 1000):
             Rebase(numFont, 1000 / upm, roundToInt=True)
 
@@ -265,7 +274,7 @@ if __name__ == '__main__':
         gsubTnum = GetGsubFlat('tnum', numFont)
         gsubOnum = GetGsubFlat('onum', numFont)
 
-        num = [numFont['cmap'][str(ord('0') + i)] for i in range(10)]
+        num = [FontCmap(numFont)[ord('0') + i] for i in range(10)]
         pnum = [gsubPnum[n] for n in num]
         onum = [gsubOnum[n] for n in pnum]
         tonum = [gsubOnum[n] for n in num]
@@ -280,6 +289,7 @@ if __name__ == '__main__':
                 numFont['glyf'][n] = Dereference(
                     numFont['glyf'][n], numFont)
 
+        changed = []
         for n in num + tonum:
             tGlyph = numFont['glyf'][n]
             tWidth = tGlyph['advanceWidth']
@@ -292,20 +302,23 @@ if __name__ == '__main__':
                 pWidth = tWidth
             if changeWidth != 0:
                 ChangeAdvanceWidth(pGlyph, changeWidth)
-                Transform(pGlyph, 1, 0, 0, 1, (changeWidth + 1) // 2, 0)
+                changed.append(pGlyph)
+        if changed:
+            TransformGlyphs(changed, 1, 0, 0, 1, (changeWidth + 1) // 2, 0)
 
         for n in num + pnum + onum + tonum:
             baseFont['glyf'][n] = numFont['glyf'][n]
         ApplyGsubSingle('pnum', baseFont)
 
-    asianFont = ReadOtz(f"build/shs/{configure.GenerateFilename(dep['CJK'])}.otz")
+    asianPath = SourcePath("CJK", dep["CJK"])
+    asianFont = pool.View(asianPath)
 
     # pre-apply `palt` in UI family
     if "UI" in param["feature"]:
         ApplyPalt(asianFont)
     else:
         NowarApplyPaltMultiplied(asianFont, 0.4)
-        asianSymbolFont = GenerateAsianSymbolFont(asianFont)
+        asianSymbolFont = GenerateAsianSymbolFont(asianFont, "{}-palt0.4".format(pool.Digest(asianPath)))
         MergeAbove(baseFont, asianSymbolFont)
 
     # pseudo-simplified font
@@ -315,26 +328,81 @@ if __name__ == '__main__':
     NowarRemoveFeatures(asianFont)
     MergeBelow(baseFont, asianFont)
 
-    # remap `丶` to `·` in RP variant
-    if "RP" in param["feature"]:
-        baseFont['cmap'][str(ord('丶'))] = baseFont['cmap'][str(ord('·'))]
-
     # romanisation
-    romaniseCyrillic = "CyR" in param["feature"]
     romaniseHanzi = "Pinyin" in param["feature"]
     romaniseHanguel = "Romaja" in param["feature"]
     if romaniseHanguel or romaniseHanzi:
-        romanFont = ReadOtz(f"build/roman/{configure.GenerateFilename(dep['Roman'])}.otz")
+        romanPath = SourcePath("Roman", dep["Roman"])
+        romanFont = pool.View(romanPath)
         MergeBelow(baseFont, romanFont)
-    if romaniseCyrillic or romaniseHanzi or romaniseHanguel:
         BuildRomanisedFont(
             baseFont,
-            romanFont if romaniseHanzi or romaniseHanguel else None,
-            cyrillic=romaniseCyrillic,
+            romanFont,
+            cyrillic=False,
             hanzi=romaniseHanzi,
-            hanguel=romaniseHanguel
+            hanguel=romaniseHanguel,
+            romanKey=pool.Digest(romanPath)
         )
 
-    Gc(baseFont)
-    Consolidate(baseFont)
-    WriteOtz(baseFont, f"build/otd/{configure.GenerateFilename(param)}.otz")
+    return baseFont
+
+
+baseCache = {}
+baseCacheSize = 2
+
+
+def GetBase(param):
+    param = configure.BaseParam(param)
+    # a long-lived server outlives its sources, a base merged from an older
+    # source must not be reused
+    source = {role: pool.Digest(SourcePath(role, dep)) for role, dep in configure.ResolveDependency(param).items()}
+    key = json.dumps({"param": param, "source": source}, sort_keys=True)
+    base = baseCache.pop(key, None)
+    if base is None:
+        base = MergeBase(param)
+    baseCache[key] = base
+    while len(baseCache) > baseCacheSize:
+        del baseCache[next(iter(baseCache))]
+    return base
+
+
+def ApplyVariant(font, param):
+    NameFont(param, font)
+
+    # oldstyle figure
+    if "OSF" in param["feature"]:
+        ApplyGsubSingle('pnum', font)
+        ApplyGsubSingle('onum', font)
+
+    # small caps
+    if "SC" in param["feature"]:
+        ApplyGsubSingle('smcp', font)
+
+    # remap `丶` to `·` in RP variant
+    if "RP" in param["feature"]:
+        RemapCmap(font, [ord('丶')], [ord('·')])
+
+    if "CyR" in param["feature"]:
+        # the letters of the base come from the Latin source, remapped by SC
+        dep = configure.ResolveDependency(param)
+        baseKey = pool.Digest(SourcePath("Latin", dep["Latin"]))
+        if "SC" in param["feature"]:
+            baseKey += "-SC"
+        BuildRomanisedFont(font, None, cyrillic=True, hanzi=False, hanguel=False, baseKey=baseKey)
+
+
+def Merge(param):
+    font = CowFont(GetBase(param))
+    ApplyVariant(font, param)
+    font = font.Materialize()
+    Gc(font)
+    Consolidate(font)
+    if len(font['glyf']) > glyphLimit:
+        raise Exception("{} glyphs, over the limit of {}".format(len(font['glyf']), glyphLimit))
+    WriteOtb(font, f"build/otd/{configure.GenerateFilename(param)}.otb")
+
+
+if __name__ == '__main__':
+    param = sys.argv[1]
+    param = json.loads(param)
+    Merge(param)
@@ -0,0 +1,273 @@
+import os
+import sys
+import json
+import mmap
+import struct
+from array import array
+
+from otdfont import Cmap
+
+
+# binary intermediate font, an alternative to zstd-compressed otfcc JSON (.otz)
+#
+# header:    magic, table count
+# directory: for each table, tag, kind, offset and length
+# tables:    8-byte aligned, either JSON or, for `glyf`, a columnar block of
+#            glyph index, metrics and flat contour arrays that can be used
+#            straight from a memory map
+otbMagic = b"OTB\x01"
+headerFormat = struct.Struct("<4sI")
+entryFormat = struct.Struct("<16sIQQ")
+
+kindJson = 0
+kindGlyf = 1
+
+flagContours = 1
+flagAdvanceWidth = 2
+
+
+def Align(n):
+    return (n + 7) & ~7
+
+
+def PackSections(sections):
+    offsets = []
+    position = Align(8 + 16 * len(sections))
+    for sec in sections:
+        offsets.append((position, len(sec)))
+        position = Align(position + len(sec))
+    out = bytearray(position)
+    struct.pack_into("<Q", out, 0, len(sections))
+    for i, ((offset, length), sec) in enumerate(zip(offsets, sections)):
+        struct.pack_into("<QQ", out, 8 + 16 * i, offset, length)
+        out[offset:offset + length] = sec
+    return bytes(out)
+
+
+def UnpackSections(buf):
+    count, = struct.unpack_from("<Q", buf, 0)
+    return [buf[offset:offset + length] for offset, length in
+            (struct.unpack_from("<QQ", buf, 8 + 16 * i) for i in range(count))]
+
+
+def Number(v):
+    return int(v) if v.is_integer() else v
+
+
+def IsSimplePoint(point):
+    return len(point) == 3 and 'x' in point and 'y' in point and 'on' in point
+
+
+def EncodeGlyf(glyf):
+    names = array('I', [0])
+    nameBytes = bytearray()
+    flags = bytearray()
+    advanceWidth = array('d')
+    pointStart = array('I', [0])
+    contourStart = array('I', [0])
+    contourEnd = array('I')
+    xs = array('d')
+    ys = array('d')
+    on = bytearray()
+    extraOffset = array('Q', [0])
+    extraBytes = bytearray()
+
+    for name, glyph in glyf.items():
+        nameBytes += name.encode()
+        names.append(len(nameBytes))
+
+        extra = dict(glyph)
+        flag = 0
+        if isinstance(extra.get('advanceWidth'), (int, float)):
+            advanceWidth.append(extra.pop('advanceWidth'))
+            flag |= flagAdvanceWidth
+        else:
+            advanceWidth.append(0)
+        contours = extra.get('contours')
+        if contours is not None and all(IsSimplePoint(p) for c in contours for p in c):
+            del extra['contours']
+            flag |= flagContours
+            for c in contours:
+                for p in c:
+                    xs.append(p['x'])
+                    ys.append(p['y'])
+                    on.append(bool(p['on']))
+                contourEnd.append(len(xs))
+        flags.append(flag)
+        pointStart.append(len(xs))
+        contourStart.append(len(contourEnd))
+
+        if extra:
+            extraBytes += json.dumps(extra, ensure_ascii=False, separators=(',', ':')).encode()
+        extraOffset.append(len(extraBytes))
+
+    return PackSections([
+        names.tobytes(), bytes(nameBytes), bytes(flags), advanceWidth.tobytes(),
+        pointStart.tobytes(), contourStart.tobytes(), contourEnd.tobytes(),
+        xs.tobytes(), ys.tobytes(), bytes(on),
+        extraOffset.tobytes(), bytes(extraBytes),
+    ])
+
+
+class GlyfColumns:
+    # column views over an encoded `glyf` block, nothing is decoded up front
+    def __init__(self, buf):
+        (names, self.nameBytes, self.flags, advanceWidth,
+         pointStart, contourStart, contourEnd,
+         xs, ys, self.on, extraOffset, self.extraBytes) = UnpackSections(buf)
+        self.names = names.cast('I')
+        self.advanceWidth = advanceWidth.cast('d')
+        self.pointStart = pointStart.cast('I')
+        self.contourStart = contourStart.cast('I')
+        self.contourEnd = contourEnd.cast('I')
+        self.xs = xs.cast('d')
+        self.ys = ys.cast('d')
+        self.extraOffset = extraOffset.cast('Q')
+
+    def __len__(self):
+        return len(self.flags)
+
+    def Name(self, i):
+        return bytes(self.nameBytes[self.names[i]:self.names[i + 1]]).decode()
+
+    def Glyph(self, i):
+        a, b = self.extraOffset[i], self.extraOffset[i + 1]
+        glyph = json.loads(bytes(self.extraBytes[a:b])) if b > a else {}
+        flag = self.flags[i]
+        if flag & flagAdvanceWidth:
+            glyph['advanceWidth'] = Number(self.advanceWidth[i])
+        if flag & flagContours:
+            contours = []
+            start = self.pointStart[i]
+            xs, ys, on = self.xs, self.ys, self.on
+            for end in self.contourEnd[self.contourStart[i]:self.contourStart[i + 1]]:
+                contours.append([
+                    {'x': Number(xs[j]), 'y': Number(ys[j]), 'on': bool(on[j])}
+                    for j in range(start, end)
+                ])
+                start = end
+            glyph['contours'] = contours
+        return glyph
+
+    def Decode(self):
+        return {self.Name(i): self.Glyph(i) for i in range(len(self))}
+
+
+def EncodeTable(tag, value):
+    if tag == 'glyf':
+        return kindGlyf, EncodeGlyf(value)
+    if isinstance(value, Cmap):
+        # the output boundary, back to otfcc's decimal string keys
+        value = value.ToJson()
+    return kindJson, json.dumps(value, ensure_ascii=False, separators=(',', ':')).encode()
+
+
+def DecodeTable(kind, buf):
+    if kind == kindGlyf:
+        return GlyfColumns(buf).Decode()
+    return json.loads(bytes(buf))
+
+
+class OtbReader:
+    def __init__(self, filename):
+        self.file = open(filename, 'rb')
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        self.view = memoryview(self.map)
+        magic, count = headerFormat.unpack_from(self.view, 0)
+        if magic != otbMagic:
+            raise ValueError("{} is not an OTB font".format(filename))
+        self.directory = {}
+        for i in range(count):
+            tag, kind, offset, length = entryFormat.unpack_from(self.view, headerFormat.size + entryFormat.size * i)
+            self.directory[tag.rstrip(b'\0').decode()] = (kind, offset, length)
+
+    def Tables(self):
+        return list(self.directory)
+
+    def Raw(self, tag):
+        kind, offset, length = self.directory[tag]
+        return kind, self.view[offset:offset + length]
+
+    def Table(self, tag):
+        return DecodeTable(*self.Raw(tag))
+
+    def Close(self):
+        try:
+            self.view.release()
+            self.map.close()
+        except BufferError:
+            # tables still viewed by the caller, the map goes with them
+            pass
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.Close()
+
+
+def ReadOtb(filename, tables=None):
+    with OtbReader(filename) as reader:
+        return {tag: reader.Table(tag) for tag in reader.Tables() if tables is None or tag in tables}
+
+
+def WriteOtbTables(entries, filename):
+    # entries: list of (tag, kind, encoded bytes)
+    position = Align(headerFormat.size + entryFormat.size * len(entries))
+    directory = []
+    for tag, kind, data in entries:
+        directory.append((tag, kind, position, len(data)))
+        position = Align(position + len(data))
+
+    tmp = filename + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(headerFormat.pack(otbMagic, len(entries)))
+        for tag, kind, offset, length in directory:
+            f.write(entryFormat.pack(tag.encode(), kind, offset, length))
+        for (tag, kind, offset, length), (_, _, data) in zip(directory, entries):
+            f.write(b'\0' * (offset - f.tell()))
+            f.write(data)
+    os.replace(tmp, filename)
+
+
+def WriteOtb(font, filename):
+    WriteOtbTables([(tag, *EncodeTable(tag, value)) for tag, value in font.items()], filename)
+
+
+def ReadFont(filename, tables=None):
+    if filename.endswith(".otb"):
+        return ReadOtb(filename, tables)
+    from libotd.otz import ReadOtz
+    return ReadOtz(filename)
+
+
+def WriteFont(font, filename):
+    if filename.endswith(".otb"):
+        return WriteOtb(font, filename)
+    from libotd.otz import WriteOtz
+    WriteOtz(font, filename)
+
+
+if __name__ == "__main__":
+    # convert between .otb, .otz and plain otfcc JSON (`-` for stdin/stdout)
+    if len(sys.argv) != 3:
+        print("usage: python otb.py <input> <output>", file=sys.stderr)
+        sys.exit(1)
+    source, target = sys.argv[1:]
+
+    if source == "-":
+        font = json.load(sys.stdin.buffer)
+    elif source.endswith((".otb", ".otz")):
+        font = ReadFont(source)
+    else:
+        with open(source, 'rb') as f:
+            font = json.load(f)
+
+    if target == "-":
+        sys.stdout.buffer.write(json.dumps(font, ensure_ascii=False).encode())
+    elif target.endswith((".otb", ".otz")):
+        WriteFont(font, target)
+    else:
+        with open(target, 'wb') as f:
+            f.write(json.dumps(font, ensure_ascii=False).encode())
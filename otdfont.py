@@ -0,0 +1,357 @@
+import marshal
+
+import numpy as np
+from collections.abc import MutableMapping
+
+
+def CopyJson(value):
+    # fast deep copy for otfcc JSON values
+    return marshal.loads(marshal.dumps(value))
+
+
+class CowTable(MutableMapping):
+    # copy-on-write view over a shared mapping.
+    # an entry is copied into `delta` when first accessed, so the base is never
+    # mutated and a derived font only costs the entries it has touched.
+    def __init__(self, base):
+        self.base = base
+        self.delta = {}
+        self.removed = set()
+
+    def Copy(self, key, value):
+        if isinstance(value, (dict, list)):
+            return CopyJson(value)
+        return value
+
+    def __getitem__(self, key):
+        if key in self.delta:
+            return self.delta[key]
+        if key in self.removed:
+            raise KeyError(key)
+        value = self.Copy(key, self.base[key])
+        if value is not self.base[key]:
+            self.delta[key] = value
+        return value
+
+    def Peek(self, key):
+        # read-only access, the result must not be modified
+        if key in self.delta:
+            return self.delta[key]
+        if key in self.removed:
+            raise KeyError(key)
+        return self.base[key]
+
+    def __setitem__(self, key, value):
+        self.delta[key] = value
+        self.removed.discard(key)
+
+    def __delitem__(self, key):
+        if key not in self:
+            raise KeyError(key)
+        self.delta.pop(key, None)
+        if key in self.base:
+            self.removed.add(key)
+
+    def __contains__(self, key):
+        return key in self.delta or (key in self.base and key not in self.removed)
+
+    def __iter__(self):
+        for key in self.base:
+            if key not in self.removed and key not in self.delta:
+                yield key
+        yield from self.delta
+
+    def __len__(self):
+        return len(self.base) - len(self.removed) + sum(1 for key in self.delta if key not in self.base)
+
+    def Modified(self):
+        return set(self.delta) | self.removed
+
+    def Materialize(self):
+        # plain dict for serialization; untouched entries are shared with the base
+        result = {k: v for k, v in self.base.items() if k not in self.removed}
+        result.update(self.delta)
+        return result
+
+
+class CowFont(CowTable):
+    # large per-glyph tables get their own copy-on-write view,
+    # other tables are copied as a whole on first access
+    cowTable = {"glyf"}
+
+    def Copy(self, key, value):
+        if key in self.cowTable:
+            return CowTable(value)
+        if isinstance(value, Cmap):
+            return value.Copy()
+        return super().Copy(key, value)
+
+    def Materialize(self):
+        # whole tables are copied as well, so that in-place passes over the
+        # result (e.g. garbage collection of lookups) never reach the base.
+        # per-glyph tables are not: their dict is copied, but untouched glyphs
+        # are the base's own objects, and a pass editing a glyph in place
+        # (Gc and Consolidate may) edits the base. that is only safe because
+        # the base is not used again after: merges run in a child forked from
+        # the source server (see `sourcepool.Serve`), or in a process of
+        # their own, and never in the process caching the base
+        result = super().Materialize()
+        for key, value in result.items():
+            if isinstance(value, CowTable):
+                result[key] = value.Materialize()
+            elif key in self.cowTable and key not in self.delta:
+                result[key] = dict(value)
+            elif isinstance(value, Cmap) and key not in self.delta:
+                result[key] = value.Copy()
+            elif key not in self.delta:
+                result[key] = CopyJson(value)
+        return result
+
+
+def RemapCmap(font, target, source):
+    # point each `target` code point at the glyph of the `source` code point
+    # at the same position, where the source is mapped. pairs take effect in
+    # order, so chains (`薴` → `苧` → `苎`) resolve as with one assignment
+    # per pair, but the cmap is only written once.
+    cmap = font['cmap']
+    if isinstance(cmap, Cmap):
+        cmap.Remap(target, source)
+        return
+    # otfcc JSON cmap, keyed by decimal strings
+    peek = cmap.Peek if isinstance(cmap, CowTable) else cmap.__getitem__
+    update = {}
+    for t, s in zip(map(str, target), map(str, source)):
+        if s in update:
+            update[t] = update[s]
+        elif s in cmap:
+            update[t] = peek(s)
+    cmap.update(update)
+
+
+class Cmap(MutableMapping):
+    # cmap as a sorted code point array with a parallel array of glyph ids
+    # into a name table, instead of otfcc's dict keyed by decimal strings.
+    # keys may be ints or decimal strings and iteration yields strings, so
+    # passes written against otfcc JSON keep working; bulk operations
+    # (`Lookup`, `Range`, `Update`, `Remap`) work on whole arrays.
+    # single new code points are collected in `pending` and merged on the
+    # next bulk operation, removed ones are marked with glyph id -1.
+    def __init__(self, code=None, glyph=None, names=None):
+        self.code = np.zeros(0, dtype=np.int64) if code is None else code
+        self.glyph = np.zeros(0, dtype=np.int32) if glyph is None else glyph
+        self.names = [] if names is None else names
+        self.nameId = {n: i for i, n in enumerate(self.names)}
+        self.pending = {}
+        self.removed = 0
+
+    @staticmethod
+    def FromJson(cmap):
+        names = sorted(set(cmap.values()))
+        nameId = {n: i for i, n in enumerate(names)}
+        code = np.fromiter(map(int, cmap.keys()), dtype=np.int64, count=len(cmap))
+        glyph = np.fromiter((nameId[n] for n in cmap.values()), dtype=np.int32, count=len(cmap))
+        order = np.argsort(code, kind='stable')
+        return Cmap(code[order], glyph[order], names)
+
+    def ToJson(self):
+        self.Flush()
+        names = self.names
+        return {str(c): names[g] for c, g in zip(self.code.tolist(), self.glyph.tolist())}
+
+    def Pack(self):
+        # marshallable form, see `Unpack`
+        self.Flush()
+        return (self.code.tobytes(), self.glyph.tobytes(), self.names)
+
+    @staticmethod
+    def Unpack(packed):
+        code, glyph, names = packed
+        return Cmap(np.frombuffer(code, dtype=np.int64).copy(), np.frombuffer(glyph, dtype=np.int32).copy(), list(names))
+
+    def Copy(self):
+        self.Flush()
+        return Cmap(self.code.copy(), self.glyph.copy(), list(self.names))
+
+    def Intern(self, name):
+        gid = self.nameId.get(name)
+        if gid is None:
+            gid = self.nameId[name] = len(self.names)
+            self.names.append(name)
+        return gid
+
+    def Flush(self):
+        if self.pending:
+            code = np.fromiter(self.pending.keys(), dtype=np.int64, count=len(self.pending))
+            glyph = np.fromiter(self.pending.values(), dtype=np.int32, count=len(self.pending))
+            code = np.concatenate([self.code, code])
+            glyph = np.concatenate([self.glyph, glyph])
+            order = np.argsort(code, kind='stable')
+            self.code, self.glyph = code[order], glyph[order]
+            self.pending = {}
+        if self.removed:
+            live = self.glyph >= 0
+            # every -1 entry is counted once, a reassigned one is no longer counted
+            assert len(live) - np.count_nonzero(live) == self.removed, "cmap removal count out of sync"
+            self.code, self.glyph = self.code[live], self.glyph[live]
+            self.removed = 0
+
+    def Find(self, cp):
+        # index of `cp` in the sorted arrays, or -1
+        i = int(np.searchsorted(self.code, cp))
+        if i < len(self.code) and self.code[i] == cp:
+            return i
+        return -1
+
+    def __getitem__(self, key):
+        cp = int(key)
+        gid = self.pending.get(cp)
+        if gid is None:
+            i = self.Find(cp)
+            gid = self.glyph[i] if i >= 0 else -1
+        if gid < 0:
+            raise KeyError(key)
+        return self.names[gid]
+
+    def __setitem__(self, key, name):
+        cp = int(key)
+        gid = self.Intern(name)
+        i = self.Find(cp) if cp not in self.pending else -1
+        if i >= 0:
+            if self.glyph[i] < 0:
+                self.removed -= 1
+            self.glyph[i] = gid
+        else:
+            self.pending[cp] = gid
+
+    def __delitem__(self, key):
+        cp = int(key)
+        if self.pending.pop(cp, None) is not None:
+            return
+        i = self.Find(cp)
+        if i < 0 or self.glyph[i] < 0:
+            raise KeyError(key)
+        self.glyph[i] = -1
+        self.removed += 1
+
+    def __contains__(self, key):
+        try:
+            cp = int(key)
+        except (TypeError, ValueError):
+            return False
+        if cp in self.pending:
+            return True
+        i = self.Find(cp)
+        return i >= 0 and self.glyph[i] >= 0
+
+    def __len__(self):
+        return len(self.code) - self.removed + len(self.pending)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        self.Flush()
+        return [str(c) for c in self.code.tolist()]
+
+    def values(self):
+        self.Flush()
+        names = self.names
+        return [names[g] for g in self.glyph.tolist()]
+
+    def items(self):
+        self.Flush()
+        names = self.names
+        return [(str(c), names[g]) for c, g in zip(self.code.tolist(), self.glyph.tolist())]
+
+    def Lookup(self, codes):
+        # glyph ids of many code points, -1 where unmapped
+        self.Flush()
+        codes = np.asarray(codes, dtype=np.int64)
+        if not len(self.code):
+            return np.full(len(codes), -1, dtype=np.int32)
+        i = np.searchsorted(self.code, codes).clip(0, len(self.code) - 1)
+        return np.where(self.code[i] == codes, self.glyph[i], -1)
+
+    def Name(self, gid):
+        return self.names[gid]
+
+    def Range(self, lo, hi):
+        # code points in [lo, hi) and their glyph names
+        self.Flush()
+        i, j = np.searchsorted(self.code, [lo, hi])
+        names = self.names
+        return self.code[i:j].tolist(), [names[g] for g in self.glyph[i:j].tolist()]
+
+    def Update(self, codes, names):
+        # bulk assignment; for repeated code points the last one wins
+        self.Flush()
+        codes = np.asarray(codes, dtype=np.int64)
+        gid = np.fromiter((self.Intern(n) for n in names), dtype=np.int32, count=len(codes))
+        self.UpdateId(codes, gid)
+
+    def UpdateId(self, codes, gid):
+        if not len(codes):
+            return
+        # pending code points would be merged in again as duplicates
+        if self.pending:
+            self.Flush()
+        # keep the last assignment of each code point
+        last = len(codes) - 1 - np.unique(codes[::-1], return_index=True)[1]
+        codes, gid = codes[last], gid[last]
+        i = np.searchsorted(self.code, codes)
+        hit = i < len(self.code)
+        hit[hit] = self.code[i[hit]] == codes[hit]
+        # reassigned code points that were removed count again
+        self.removed -= int(np.count_nonzero(self.glyph[i[hit]] < 0))
+        self.glyph[i[hit]] = gid[hit]
+        new = ~hit
+        if new.any():
+            code = np.concatenate([self.code, codes[new]])
+            glyph = np.concatenate([self.glyph, gid[new]])
+            order = np.argsort(code, kind='stable')
+            self.code, self.glyph = code[order], glyph[order]
+
+    def Remap(self, target, source):
+        # as `RemapCmap`: sources are looked up in one batch, chains through
+        # earlier targets are resolved in order, targets written in one batch
+        target = np.asarray(target, dtype=np.int64)
+        source = np.asarray(source, dtype=np.int64)
+        value = self.Lookup(source)
+        for k in np.nonzero(np.isin(source, target))[0].tolist():
+            earlier = np.nonzero((target[:k] == source[k]) & (value[:k] >= 0))[0]
+            if len(earlier):
+                value[k] = value[earlier[-1]]
+        hit = value >= 0
+        self.UpdateId(target[hit], value[hit].astype(np.int32))
+
+
+def FontCmap(font):
+    # the cmap of a font as `Cmap`, converting an otfcc JSON one in place
+    cmap = font['cmap']
+    if not isinstance(cmap, Cmap):
+        cmap = Cmap.FromJson(cmap)
+        font['cmap'] = cmap
+    return cmap
+
+
+def ExtractSubFont(font, codePoints):
+    # cmap and glyphs of `codePoints`, with every glyph they reference,
+    # found by lookup rather than by scanning the whole font
+    cmap = FontCmap(font)
+    codes = np.asarray(codePoints, dtype=np.int64)
+    gid = cmap.Lookup(codes)
+    hit = gid >= 0
+    subCmap = Cmap()
+    subCmap.Update(codes[hit], [cmap.Name(g) for g in gid[hit].tolist()])
+
+    glyf = font['glyf']
+    subGlyf = {}
+    stack = list(subCmap.values())
+    while stack:
+        name = stack.pop()
+        if name in subGlyf or name not in glyf:
+            continue
+        glyph = CopyJson(glyf[name])
+        subGlyf[name] = glyph
+        stack.extend(ref['glyph'] for ref in glyph.get('references', []))
+    return {"cmap": subCmap, "glyf": subGlyf}
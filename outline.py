@@ -0,0 +1,142 @@
+import numpy as np
+
+from libotd.rebase import Rebase as RebaseTables
+from otb import Number
+
+
+# glyph outlines as arrays.
+# an otfcc glyph stores each point as a {'x', 'y', 'on'} dict, so every
+# geometric pass walks the points one by one in Python. an `Outline` keeps
+# all points of a glyph in one N×2 array with an on-curve mask and contour
+# end indices, and transforms them in a single array operation.
+class Outline:
+    def __init__(self, points, on, ends):
+        self.points = points
+        self.on = on
+        self.ends = ends
+
+    @staticmethod
+    def FromContours(contours):
+        points = [(p['x'], p['y']) for c in contours for p in c]
+        on = [bool(p['on']) for c in contours for p in c]
+        return Outline(
+            np.array(points, dtype=np.float64).reshape(-1, 2),
+            np.array(on, dtype=bool),
+            np.cumsum([len(c) for c in contours], dtype=np.int64),
+        )
+
+    @staticmethod
+    def Concat(outlines):
+        outlines = list(outlines)
+        if not outlines:
+            return Outline.FromContours([])
+        offset = np.cumsum([0] + [len(o.points) for o in outlines[:-1]])
+        return Outline(
+            np.concatenate([o.points for o in outlines]),
+            np.concatenate([o.on for o in outlines]),
+            np.concatenate([o.ends + n for o, n in zip(outlines, offset)]),
+        )
+
+    def __len__(self):
+        return len(self.ends)
+
+    def Transform(self, a, b, c, d, x, y):
+        # PostScript order, as in otfcc references:
+        # x' = a x + c y + dx, y' = b x + d y + dy
+        matrix = np.array([[a, b], [c, d]], dtype=np.float64)
+        return Outline(self.points @ matrix + (x, y), self.on, self.ends)
+
+    def Scale(self, scale, roundToInt=False):
+        points = self.points * scale
+        if roundToInt:
+            points = np.rint(points)
+        return Outline(points, self.on, self.ends)
+
+    def ToContours(self):
+        points = self.points.tolist()
+        on = self.on.tolist()
+        contours = []
+        start = 0
+        for end in self.ends.tolist():
+            contours.append([
+                {'x': Number(points[i][0]), 'y': Number(points[i][1]), 'on': on[i]}
+                for i in range(start, end)
+            ])
+            start = end
+        return contours
+
+
+def GlyphOutline(glyph, font, cache=None):
+    # outline of a glyph with its references resolved
+    outlines = [Outline.FromContours(glyph.get('contours', []))]
+    for ref in glyph.get('references', []):
+        name = ref['glyph']
+        if cache is not None and name in cache:
+            part = cache[name]
+        else:
+            part = GlyphOutline(font['glyf'][name], font, cache)
+            if cache is not None:
+                cache[name] = part
+        outlines.append(part.Transform(ref['a'], ref['b'], ref['c'], ref['d'], ref['x'], ref['y']))
+    return Outline.Concat(outlines)
+
+
+def Dereference(glyph, font, cache=None):
+    # drop-in replacement for `libotd.dereference.Dereference`;
+    # `cache` maps glyph names to their resolved outlines and may be shared
+    # between calls over the same font
+    result = {k: v for k, v in glyph.items() if k not in ('contours', 'references')}
+    result['contours'] = GlyphOutline(glyph, font, cache).ToContours()
+    return result
+
+
+def TransformGlyphs(glyphs, a, b, c, d, x, y):
+    # one affine transform for the contours of many glyphs, in place
+    glyphs = list(glyphs)
+    outlined = [g for g in glyphs if g.get('contours')]
+    outline = Outline.Concat(Outline.FromContours(g['contours']) for g in outlined)
+    contours = outline.Transform(a, b, c, d, x, y).ToContours()
+    start = 0
+    for g in outlined:
+        n = len(g['contours'])
+        g['contours'] = contours[start:start + n]
+        start += n
+    for g in glyphs:
+        for ref in g.get('references', []):
+            ref['x'], ref['y'] = a * ref['x'] + c * ref['y'] + x, b * ref['x'] + d * ref['y'] + y
+
+
+def Rebase(font, scale, roundToInt=False):
+    # as `libotd.rebase.Rebase`, with the glyph outlines of the whole font
+    # scaled as one array; the other tables go through libotd
+    glyf = font['glyf']
+    font['glyf'] = {}
+    try:
+        RebaseTables(font, scale, roundToInt=roundToInt)
+    finally:
+        font['glyf'] = glyf
+
+    def Scale(v):
+        v *= scale
+        return round(v) if roundToInt else v
+
+    glyphs = [g for g in glyf.values() if g.get('contours')]
+    outline = Outline.Concat(Outline.FromContours(g['contours']) for g in glyphs)
+    contours = outline.Scale(scale, roundToInt).ToContours()
+    start = 0
+    for g in glyphs:
+        n = len(g['contours'])
+        g['contours'] = contours[start:start + n]
+        start += n
+
+    for g in glyf.values():
+        for key in ('advanceWidth', 'advanceHeight', 'verticalOrigin'):
+            if key in g:
+                g[key] = Scale(g[key])
+        for ref in g.get('references', []):
+            ref['x'] = Scale(ref['x'])
+            ref['y'] = Scale(ref['y'])
+        for key in ('stemH', 'stemV'):
+            for stem in g.get(key, []):
+                stem['position'] = Scale(stem['position'])
+                stem['width'] = Scale(stem['width'])
@@ -0,0 +1,189 @@
+import os
+import sys
+import errno
+import json
+import fcntl
+import shutil
+import hashlib
+import tempfile
+
+from stagememory import RunChild
+
+
+# font packs assembled from a content-addressed store.
+#
+# each distinct font is stored once under its digest, read-only, and
+# hardlinked into the pack directories, and so is each archive. 7z cannot
+# splice members compressed before, so an archive is compressed whole; but
+# packs with the same content, listed in a manifest, share one archive
+# compressed once.
+#
+# every pack directory records the objects and archive it uses last; what no
+# record refers to is pruned once no pack is running.
+storeRoot = "build/pack-store"
+archiveOption = ["-t7z", "-m0=LZMA:d=512m:fb=273", "-ms"]
+FICLONE = 0x40049409  # linux/fs.h
+readOnly = 0o444
+
+digestCache = {}
+
+
+def Digest(filename):
+    stat = os.stat(filename)
+    key = (filename, stat.st_mtime_ns, stat.st_size)
+    if key not in digestCache:
+        h = hashlib.sha256()
+        with open(filename, 'rb') as f:
+            for chunk in iter(lambda: f.read(1 << 20), b''):
+                h.update(chunk)
+        digestCache[key] = h.hexdigest()
+    return digestCache[key]
+
+
+def Link(source, target, hardlink=True):
+    # `target` with the content of `source`: a hardlink, or where that cannot
+    # be, across file systems or with `hardlink` off, a reflink or a copy
+    if hardlink and os.path.exists(target) and os.path.samefile(source, target):
+        # a rename onto another link of the same file does nothing, and
+        # would leave the temporary link behind
+        return
+    directory = os.path.dirname(target) or "."
+    fd, tmp = tempfile.mkstemp(dir=directory)
+    os.close(fd)
+    os.unlink(tmp)
+    try:
+        if hardlink:
+            try:
+                os.link(source, tmp)
+            except OSError as e:
+                if e.errno != errno.EXDEV:
+                    raise
+                hardlink = False
+        if not hardlink:
+            with open(source, 'rb') as src, open(tmp, 'wb') as dst:
+                try:
+                    fcntl.ioctl(dst.fileno(), FICLONE, src.fileno())
+                except OSError:
+                    shutil.copyfileobj(src, dst, 1 << 20)
+            os.chmod(tmp, readOnly)
+        os.replace(tmp, target)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+
+
+def Store(filename, suffix):
+    # path of the stored object of `filename`'s content
+    obj = os.path.join(storeRoot, "objects", Digest(filename) + suffix)
+    if not os.path.exists(obj):
+        os.makedirs(os.path.dirname(obj), exist_ok=True)
+        # set-encoding rewrites its outputs in place, so the store takes
+        # one copy of each distinct font; packs hardlink that copy
+        Link(filename, obj, hardlink=False)
+    return obj
+
+
+def Reference(directory):
+    # record of the store entries used by the pack in `directory`
+    return os.path.join(storeRoot, "manifests", hashlib.sha256(directory.encode()).hexdigest() + ".json")
+
+
+def Prune():
+    # remove store entries no pack refers to; a pack whose archive is gone
+    # from out/ no longer refers to anything
+    referenced = set()
+    manifests = os.path.join(storeRoot, "manifests")
+    for name in os.listdir(manifests) if os.path.isdir(manifests) else []:
+        path = os.path.join(manifests, name)
+        try:
+            with open(path) as f:
+                ref = json.load(f)
+        except (OSError, ValueError):
+            ref = None
+        if not ref or not os.path.exists(ref["archive"]):
+            os.unlink(path)
+            continue
+        referenced.update(ref["object"])
+        referenced.add(ref["stored"])
+    # leftover temporary files of interrupted packs go as well
+    for kind in ("objects", "archives"):
+        root = os.path.join(storeRoot, kind)
+        for name in os.listdir(root) if os.path.isdir(root) else []:
+            if name not in referenced:
+                os.unlink(os.path.join(root, name))
+
+
+def Pack(param):
+    # param: {"directory": pack directory, "archive": output,
+    #         "member": {path in archive: source file}}
+    os.makedirs(storeRoot, exist_ok=True)
+    with open(os.path.join(storeRoot, "lock"), 'a') as lock:
+        # packs share the store, pruning waits for all of them
+        fcntl.flock(lock, fcntl.LOCK_SH)
+        PackLocked(param)
+        fcntl.flock(lock, fcntl.LOCK_UN)
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            # another pack is running, the last one to finish prunes
+            return
+        Prune()
+
+
+def PackLocked(param):
+    directory, archive = param["directory"], param["archive"]
+    member = {name: Store(source, os.path.splitext(source)[1]) for name, source in param["member"].items()}
+
+    for name, obj in member.items():
+        path = os.path.join(directory, name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        Link(obj, path)
+    # leftovers of an earlier configuration would end up in the archive
+    for root, _, files in os.walk(directory):
+        for f in files:
+            if os.path.relpath(os.path.join(root, f), directory) not in member:
+                os.unlink(os.path.join(root, f))
+
+    manifest = json.dumps({
+        "option": archiveOption,
+        "member": {name: os.path.basename(obj) for name, obj in sorted(member.items())},
+    }, sort_keys=True)
+    stored = os.path.join(storeRoot, "archives", hashlib.sha256(manifest.encode()).hexdigest() + ".7z")
+    if not os.path.exists(stored):
+        os.makedirs(os.path.dirname(stored), exist_ok=True)
+        # a name of our own, 7z would add to an archive already there
+        fd, tmp = tempfile.mkstemp(suffix=".7z", dir=os.path.dirname(stored))
+        os.close(fd)
+        os.unlink(tmp)
+        roots = sorted({name.split("/")[0] for name in member})
+        try:
+            code = RunChild(["7z", "a", *archiveOption, os.path.abspath(tmp), *roots], cwd=directory)
+            if code:
+                raise RuntimeError("7z exited with status {}".format(code))
+            os.chmod(tmp, readOnly)
+            os.replace(tmp, stored)
+        finally:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+    os.makedirs(os.path.dirname(archive), exist_ok=True)
+    Link(stored, archive)
+    # a reused archive is older than the fonts it was made from
+    os.utime(archive)
+
+    ref = Reference(directory)
+    os.makedirs(os.path.dirname(ref), exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(ref))
+    with os.fdopen(fd, 'w') as f:
+        json.dump({
+            "archive": archive,
+            "stored": os.path.basename(stored),
+            "object": sorted({os.path.basename(obj) for obj in member.values()}),
+        }, f, sort_keys=True)
+    os.replace(tmp, ref)
+
+
+if __name__ == '__main__':
+    param = sys.argv[1]
+    param = json.loads(param)
+    Pack(param)
@@ -0,0 +1,117 @@
+import os
+import sys
+import mmap
+import struct
+from bisect import bisect_left
+from collections.abc import Mapping
+
+
+# pinyin of frequently used hanzi, compiled from `pinyindata.py`.
+#
+# header:    magic, hanzi count, syllable count
+# hanzi:     sorted code points (u32), then a syllable id for each (u16)
+# syllables: offsets into the string table (u32, count + 1), then UTF-8 bytes
+#
+# the table is mapped and searched in place, nothing is parsed on import.
+pinyinMagic = b"PYD\x01"
+headerFormat = struct.Struct("<4sII")
+dataFile = os.path.join(os.path.dirname(os.path.abspath(__file__)), "pinyin.dat")
+
+
+class PinyinTable(Mapping):
+    # read-only {hanzi: toned syllable} view, as `pinyindata.data`
+    def __init__(self, filename):
+        with open(filename, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        view = memoryview(self.map)
+        magic, count, syllableCount = headerFormat.unpack_from(view, 0)
+        if magic != pinyinMagic:
+            raise ValueError("{} is not a pinyin table".format(filename))
+        position = headerFormat.size
+        self.codePoint = view[position:position + 4 * count].cast('I')
+        position += 4 * count
+        self.syllableId = view[position:position + 2 * count].cast('H')
+        position += 2 * count + (2 * count) % 4
+        self.syllableOffset = view[position:position + 4 * (syllableCount + 1)].cast('I')
+        position += 4 * (syllableCount + 1)
+        self.syllableBytes = view[position:]
+        self.syllable = {}
+
+    def Index(self, cp):
+        i = bisect_left(self.codePoint, cp)
+        if i < len(self.codePoint) and self.codePoint[i] == cp:
+            return i
+        return None
+
+    def Syllable(self, sid):
+        if sid not in self.syllable:
+            a, b = self.syllableOffset[sid], self.syllableOffset[sid + 1]
+            self.syllable[sid] = bytes(self.syllableBytes[a:b]).decode()
+        return self.syllable[sid]
+
+    def Lookup(self, cp):
+        # toned syllable of a code point, or None
+        i = self.Index(cp)
+        return None if i is None else self.Syllable(self.syllableId[i])
+
+    def __getitem__(self, ch):
+        result = self.Lookup(ord(ch)) if isinstance(ch, str) and len(ch) == 1 else None
+        if result is None:
+            raise KeyError(ch)
+        return result
+
+    def __contains__(self, ch):
+        return isinstance(ch, str) and len(ch) == 1 and self.Index(ord(ch)) is not None
+
+    def __iter__(self):
+        return (chr(cp) for cp in self.codePoint)
+
+    def __len__(self):
+        return len(self.codePoint)
+
+    def items(self):
+        return ((chr(cp), self.Syllable(sid)) for cp, sid in zip(self.codePoint, self.syllableId))
+
+
+def Compile(data, filename):
+    syllables = sorted(set(data.values()))
+    syllableId = {s: i for i, s in enumerate(syllables)}
+    hanzi = sorted(data, key=ord)
+
+    encoded = [s.encode() for s in syllables]
+    offsets = [0]
+    for s in encoded:
+        offsets.append(offsets[-1] + len(s))
+
+    count = len(hanzi)
+    out = bytearray(headerFormat.pack(pinyinMagic, count, len(syllables)))
+    out += struct.pack("<{}I".format(count), *(ord(ch) for ch in hanzi))
+    out += struct.pack("<{}H".format(count), *(syllableId[data[ch]] for ch in hanzi))
+    # keep the offsets 4-byte aligned for the memoryview cast
+    out += b'\0' * ((2 * count) % 4)
+    out += struct.pack("<{}I".format(len(offsets)), *offsets)
+    out += b''.join(encoded)
+
+    tmp = filename + ".tmp"
+    with open(tmp, 'wb') as f:
+        f.write(out)
+    os.replace(tmp, filename)
+
+
+table = None
+
+
+def __getattr__(name):
+    # `pinyin.data` maps the table on first use
+    global table
+    if name == "data":
+        if table is None:
+            table = PinyinTable(dataFile)
+        return table
+    raise AttributeError("module {!r} has no attribute {!r}".format(__name__, name))
+
+
+if __name__ == "__main__":
+    # regenerate `pinyin.dat` after editing `pinyindata.py`
+    import pinyindata
+    Compile(pinyindata.data, sys.argv[1] if len(sys.argv) > 1 else dataFile)
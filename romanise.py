@@ -1,6 +1,12 @@
+import os
+import sys
+import signal
+import marshal
+import hashlib
+import traceback
 import unicodedata
-import pinyindata
-from libotd.dereference import Dereference
+from outline import Dereference
+from otdfont import FontCmap
 from libotd.gsub import GetGsubFlat
 
 # ISO 9:1995 or GOST 2002
@@ -228,16 +234,16 @@ def ExtractRomanGlyph(romanFont):
     baseCharList = "ABCDEFGHIJKLMNOPQRSTUVWXYZ" "abcdefghijklmnopqrstuvwxyz" "ü" "ʺʹ"
     markCharList = "\u0300\u0301\u0302\u0304\u0308\u030c"
 
-    cmap = romanFont['cmap']
+    cmap = FontCmap(romanFont)
     glyf = romanFont['glyf']
-    markLut = GetGposMark(romanFont, cmap[str(ord('a'))], cmap[str(0x0302)])
-    anchor = markLut['marks'][cmap[str(0x0302)]]['class']
+    markLut = GetGposMark(romanFont, cmap[ord('a')], cmap[0x0302])
+    anchor = markLut['marks'][cmap[0x0302]]['class']
 
     smcp = GetGsubFlat('smcp', romanFont)
     pnum = GetGsubFlat('pnum', romanFont)
     glyphMap = {}
     for ch in baseCharList:
-        orig = cmap[str(ord(ch))]
+        orig = cmap[ord(ch)]
         sub = smcp.get(orig, orig)
         mark = markLut['bases'].get(sub)
         glyph = Dereference(glyf[sub], romanFont)
@@ -256,7 +262,7 @@ def ExtractRomanGlyph(romanFont):
             'isMark': False,
         }
     for ch in markCharList:
-        name = cmap[str(ord(ch))]
+        name = cmap[ord(ch)]
         mark = markLut['marks'][name]
         mark = (mark['x'], mark['y'])
         glyph = Dereference(glyf[name], romanFont)
@@ -269,6 +275,56 @@ def ExtractRomanGlyph(romanFont):
     return glyphMap
 
 
+# extracted roman glyph maps, by a key naming the font they come from.
+# the extraction scans GPOS and GSUB and dereferences every letter and mark,
+# while the result depends only on the source font, so it is kept in process
+# for the merges of a source server and persisted under `build/roman-glyph`.
+romanGlyphMagic = b"RGM\x01"
+romanGlyphDirectory = "build/roman-glyph"
+romanGlyphCache = {}
+# the persisted maps are also keyed by the code that extracts them
+romanGlyphScript = ["romanise.py", "outline.py"]
+romanGlyphCodeDigest = None
+
+
+def RomanGlyphCodeDigest():
+    global romanGlyphCodeDigest
+    if romanGlyphCodeDigest is None:
+        h = hashlib.sha256()
+        for script in romanGlyphScript:
+            with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), script), 'rb') as f:
+                h.update(f.read())
+        romanGlyphCodeDigest = h.hexdigest()[:8]
+    return romanGlyphCodeDigest
+
+
+def LoadRomanGlyph(font, key=None):
+    if key is None:
+        return ExtractRomanGlyph(font)
+    if key in romanGlyphCache:
+        return romanGlyphCache[key]
+
+    filename = "{}/{}-{}.bin".format(romanGlyphDirectory, key, RomanGlyphCodeDigest())
+    glyphMap = None
+    try:
+        with open(filename, 'rb') as f:
+            data = f.read()
+        if data[:4] == romanGlyphMagic:
+            glyphMap = marshal.loads(data[4:])
+    except (OSError, EOFError, ValueError, TypeError):
+        pass
+    if glyphMap is None:
+        glyphMap = ExtractRomanGlyph(font)
+        os.makedirs(romanGlyphDirectory, exist_ok=True)
+        tmp = "{}.{}.tmp".format(filename, os.getpid())
+        with open(tmp, 'wb') as f:
+            f.write(romanGlyphMagic + marshal.dumps(glyphMap))
+        os.replace(tmp, filename)
+
+    romanGlyphCache[key] = glyphMap
+    return glyphMap
+
+
 def BuildComposedGlyph(baseGlyphName, baseGlyphWidth, str, romanGlyphs):
     mark = None
     advanceWidth = baseGlyphWidth
@@ -308,11 +364,12 @@ def BuildComposedGlyph(baseGlyphName, baseGlyphWidth, str, romanGlyphs):
     }
 
 
-def BuildCyrInversedGlyphs(baseFont):
+def BuildCyrInversedGlyphs(baseFont, baseKey=None):
     ascender = baseFont['OS_2']['sTypoAscender']
     descender = baseFont['OS_2']['sTypoDescender']
 
-    romanGlyphMap = ExtractRomanGlyph(baseFont)
+    romanGlyphMap = LoadRomanGlyph(baseFont, baseKey)
+    cmap = FontCmap(baseFont)
     def reverseContour(d): return d[0:1] + d[-1:0:-1]
 
     for ch, subs in cyrMap.items():
@@ -338,18 +395,18 @@ def BuildCyrInversedGlyphs(baseFont):
                 {'x': width, 'y': descender, 'on': True},
             ])
 
-        cmapKey = str(ord(ch))
-        glyphName = baseFont['cmap'][cmapKey]
+        glyphName = cmap[ord(ch)]
         subGlyphName = glyphName + ".cyr_roman." + subs
         baseFont['glyf'][subGlyphName] = glyph
-        baseFont['cmap'][cmapKey] = subGlyphName
+        cmap[ord(ch)] = subGlyphName
 
 
-def BuildCyrUnderlinedGlyphs(baseFont):
+def BuildCyrUnderlinedGlyphs(baseFont, baseKey=None):
     ascender = baseFont['OS_2']['sTypoAscender']
     descender = baseFont['OS_2']['sTypoDescender']
 
-    romanGlyphMap = ExtractRomanGlyph(baseFont)
+    romanGlyphMap = LoadRomanGlyph(baseFont, baseKey)
+    cmap = FontCmap(baseFont)
 
     for ch, subs in cyrMap.items():
         glyph = Dereference(BuildComposedGlyph(
@@ -374,29 +431,152 @@ def BuildCyrUnderlinedGlyphs(baseFont):
                 {'x': width + padding, 'y': descender, 'on': True},
             ])
 
-        cmapKey = str(ord(ch))
-        glyphName = baseFont['cmap'][cmapKey]
+        glyphName = cmap[ord(ch)]
         subGlyphName = glyphName + ".cyr_roman." + subs
         baseFont['glyf'][subGlyphName] = glyph
-        baseFont['cmap'][cmapKey] = subGlyphName
+        cmap[ord(ch)] = subGlyphName
 
 
-def BuildHanguelComposedGlyphs(baseFont, romanFont):
-    romanGlyphMap = ExtractRomanGlyph(romanFont)
+def ComposeSyllable(baseFont, width, syllable, romanGlyphs, cache, outlineCache):
+    # the romanised part of a composed glyph depends only on the syllable and
+    # the width of the glyph it follows, build and dereference it once
+    key = (syllable, width)
+    if key not in cache:
+        glyph = BuildComposedGlyph(None, width, syllable, romanGlyphs)
+        if "CFF_" in baseFont:
+            glyph = Dereference(glyph, baseFont, outlineCache)
+        cache[key] = glyph
+    return cache[key]
 
+
+def BuildSyllableGlyph(baseFont, glyphName, width, syllable, romanGlyphs, cache, outlineCache):
+    syllableGlyph = ComposeSyllable(baseFont, width, syllable, romanGlyphs, cache, outlineCache)
+    baseReference = {
+        'glyph': glyphName,
+        'x': 0, 'y': 0,
+        'a': 1, 'b': 0, 'c': 0, 'd': 1,
+    }
+    if "CFF_" in baseFont:
+        glyph = Dereference({
+            'advanceWidth': syllableGlyph['advanceWidth'],
+            'references': [baseReference],
+        }, baseFont)
+        # syllable contours go first, so every glyph sharing the syllable
+        # starts with the same charstring and the CFF subroutinizer stores
+        # it once. the cached syllable is copied, a later pass over one
+        # glyph must not change every glyph of its syllable
+        contours = [[dict(point) for point in c] for c in syllableGlyph['contours']]
+        glyph['contours'] = contours + glyph.get('contours', [])
+        return glyph
+    return {
+        'advanceWidth': syllableGlyph['advanceWidth'],
+        'references': [baseReference] + [dict(r) for r in syllableGlyph['references']],
+    }
+
+
+# composed glyphs are built in forked processes that inherit the merged font
+# and the roman glyph map. merges already run in daemonic workers, which
+# multiprocessing does not allow to start a pool, hence the plain fork.
+# below this, forking and shipping glyphs back costs more than it saves
+romaniseChunkSize = 256
+
+
+def RomaniseJobs():
+    # the build driver runs several merges at once and sets the fan-out of
+    # each, so that the workers of all merges together match the cores; read
+    # per merge, this module may have been imported before the driver set it
+    return int(os.environ.get("NOWAR_ROMANISE_JOBS", 0)) or os.cpu_count() or 1
+
+
+def ForkMap(function, chunks):
+    children = []
+    for chunk in chunks:
+        r, w = os.pipe()
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            os.close(r)
+            code = 0
+            try:
+                with os.fdopen(w, 'wb') as f:
+                    f.write(marshal.dumps(function(chunk)))
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+        os.close(w)
+        children.append((pid, r))
+
+    results = []
+    try:
+        while children:
+            pid, r = children[0]
+            with os.fdopen(r, 'rb') as f:
+                data = f.read()
+            _, status = os.waitpid(pid, 0)
+            children.pop(0)
+            code = os.waitstatus_to_exitcode(status)
+            if code:
+                raise RuntimeError("romanisation worker exited with status {}".format(code))
+            results.append(marshal.loads(data))
+    finally:
+        # on failure, no worker outlives the call, the caller may be a long-lived server
+        for pid, r in children:
+            try:
+                os.kill(pid, signal.SIGKILL)
+            except ProcessLookupError:
+                pass
+            os.waitpid(pid, 0)
+            try:
+                os.close(r)
+            except OSError:
+                pass
+    return results
+
+
+def BuildSyllableGlyphs(baseFont, task, romanGlyphs):
+    # task: list of (code point, base glyph name, syllable, composed glyph name)
+    def build(chunk):
+        syllableCache = {}
+        # resolved outlines of the roman glyphs
+        outlineCache = {}
+        result = []
+        for cp, glyphName, syllable, composedGlyphName in chunk:
+            width = baseFont['glyf'][glyphName]['advanceWidth']
+            glyph = BuildSyllableGlyph(baseFont, glyphName, width, syllable, romanGlyphs, syllableCache, outlineCache)
+            result.append((cp, composedGlyphName, glyph))
+        return result
+
+    # TrueType composed glyphs are reference lists, cheaper to build than
+    # to ship back from a worker
+    jobs = min(RomaniseJobs(), len(task) // romaniseChunkSize)
+    if "CFF_" not in baseFont or jobs < 2:
+        result = build(task)
+    else:
+        # keep a syllable in one worker, so that it is dereferenced once
+        task = sorted(task, key=lambda t: t[2])
+        size = -(-len(task) // jobs)
+        result = [r for chunk in ForkMap(build, [task[i:i + size] for i in range(0, len(task), size)]) for r in chunk]
+
+    for cp, composedGlyphName, glyph in result:
+        baseFont['glyf'][composedGlyphName] = glyph
+    FontCmap(baseFont).Update([r[0] for r in result], [r[1] for r in result])
+
+
+def BuildHanguelComposedGlyphs(baseFont, romanFont, romanKey=None):
+    romanGlyphMap = LoadRomanGlyph(romanFont, romanKey)
+    cmap = FontCmap(baseFont)
+
+    task = []
     for ch in adobeKr0:
         cp = ord(ch)
-        cmapKey = str(cp)
-        glyphName = baseFont['cmap'][cmapKey]
-        width = baseFont['glyf'][glyphName]['advanceWidth']
+        glyphName = cmap[cp]
         trans = HanguelTranscript(cp)
-        glyph = BuildComposedGlyph(glyphName, width, trans, romanGlyphMap)
-        if "CFF_" in baseFont:
-            glyph = Dereference(glyph, baseFont)
-
-        composedGlyphName = glyphName + ".romaja." + trans
-        baseFont['glyf'][composedGlyphName] = glyph
-        baseFont['cmap'][cmapKey] = composedGlyphName
+        task.append((cp, glyphName, trans, glyphName + ".romaja." + trans))
+    BuildSyllableGlyphs(baseFont, task, romanGlyphMap)
 
 
 def NormalizePinyin(syllable):
@@ -406,31 +586,31 @@ def NormalizePinyin(syllable):
     return nfd.replace("u\u0308", "ü")
 
 
-def BuildHanziComposedGlyphs(baseFont, romanFont):
-    romanGlyphMap = ExtractRomanGlyph(romanFont)
+def BuildHanziComposedGlyphs(baseFont, romanFont, romanKey=None):
+    # the pinyin table is only mapped by merges that romanise hanzi
+    from pinyin import data as pinyinData
+    romanGlyphMap = LoadRomanGlyph(romanFont, romanKey)
+
+    cmap = FontCmap(baseFont)
 
-    for ch, pinyin in pinyindata.data.items():
+    # ~10k hanzi share ~1300 toned syllables
+    task = []
+    for ch, pinyin in pinyinData.items():
         cp = ord(ch)
         if cp < 0x4e00 or cp >= 0xa000:
             # process uro only
             continue
-        cmapKey = str(cp)
-        glyphName = baseFont['cmap'][cmapKey]
-        width = baseFont['glyf'][glyphName]['advanceWidth']
-        normalized = NormalizePinyin(pinyin)
-        glyph = BuildComposedGlyph(glyphName, width, normalized, romanGlyphMap)
-        if "CFF_" in baseFont:
-            glyph = Dereference(glyph, baseFont)
-
-        composedGlyphName = glyphName + ".romaja." + pinyin
-        baseFont['glyf'][composedGlyphName] = glyph
-        baseFont['cmap'][cmapKey] = composedGlyphName
+        glyphName = cmap[cp]
+        task.append((cp, glyphName, NormalizePinyin(pinyin), glyphName + ".romaja." + pinyin))
+    BuildSyllableGlyphs(baseFont, task, romanGlyphMap)
 
 
-def BuildRomanisedFont(baseFont, romanFont, cyrillic, hanzi, hanguel):
+def BuildRomanisedFont(baseFont, romanFont, cyrillic, hanzi, hanguel, baseKey=None, romanKey=None):
+    # baseKey, romanKey: names under which the roman glyph maps extracted from
+    # `baseFont` and `romanFont` are cached, e.g. digests of their sources
     if cyrillic:
-        BuildCyrUnderlinedGlyphs(baseFont)
+        BuildCyrUnderlinedGlyphs(baseFont, baseKey)
     if hanzi:
-        BuildHanziComposedGlyphs(baseFont, romanFont)
+        BuildHanziComposedGlyphs(baseFont, romanFont, romanKey)
     if hanguel:
-        BuildHanguelComposedGlyphs(baseFont, romanFont)
+        BuildHanguelComposedGlyphs(baseFont, romanFont, romanKey)
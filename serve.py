@@ -0,0 +1,216 @@
+import os
+import sys
+import argparse
+import threading
+import socketserver
+from collections import OrderedDict
+from urllib.parse import urlsplit, parse_qs
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import configure
+from sfnt import codePageBit
+from build import Builder, BuildError
+from buildcache import BuildCache, CopyFile
+from sourcepool import SourceServerGroup
+
+
+# local build service: fonts of any weight on request.
+#
+#   GET /font?weight=372&width=7&region=CN&feature=RP,SC&encoding=gbk
+#
+# the service keeps its source servers, and so the parsed sources and merged
+# bases, between requests; a variant of a base built before is one fork and
+# one compile away. finished fonts are kept in a size-bounded LRU store.
+encodings = {"unspec", "abg", *codePageBit}
+# widths with a Noto instance, and the Warcraft numeral hack
+widths = {*configure.notoWidthMap, 10}
+
+
+def ParseQuery(query):
+    # query string to a Nowar param; raises ValueError on anything unknown
+    query = {k: v[-1] for k, v in parse_qs(query).items()}
+    try:
+        weight = int(query.get("weight", 400))
+        width = int(query.get("width", 7))
+    except ValueError:
+        raise ValueError("weight and width must be integers")
+    if not configure.weightRange[0] <= weight <= configure.weightRange[1]:
+        raise ValueError("weight {} out of range {}..{}".format(weight, *configure.weightRange))
+    if width not in widths:
+        raise ValueError("width must be one of {}".format(sorted(widths)))
+    region = query.get("region", "CN")
+    if region not in configure.shsRegionMap:
+        raise ValueError("unknown region {}".format(region))
+    feature = sorted({f for f in query.get("feature", "").split(",") if f})
+    for f in feature:
+        if f not in configure.featureNameMap:
+            raise ValueError("unknown feature {}".format(f))
+    encoding = query.get("encoding", "unspec")
+    if encoding not in encodings:
+        raise ValueError("unknown encoding {}".format(encoding))
+    return {
+        "family": "Nowar",
+        "weight": weight,
+        "width": width,
+        "region": region,
+        "feature": feature,
+        "encoding": encoding,
+    }
+
+
+class FontStore:
+    # finished fonts by file name, least recently used evicted first once
+    # the store grows over `capacity` bytes
+    def __init__(self, root, capacity):
+        self.root = root
+        self.capacity = capacity
+        self.lock = threading.Lock()
+        self.entry = OrderedDict()
+        os.makedirs(root, exist_ok=True)
+        stored = [(os.stat(os.path.join(root, name)), name) for name in os.listdir(root) if name.endswith(".otf")]
+        for stat, name in sorted(stored, key=lambda x: x[0].st_mtime_ns):
+            self.entry[name] = stat.st_size
+        self.size = sum(self.entry.values())
+
+    def Path(self, name):
+        return os.path.join(self.root, name)
+
+    def Read(self, name):
+        # content of a stored font, or None; read under the lock, so that
+        # a concurrent `Put` cannot evict it half way
+        with self.lock:
+            if name not in self.entry:
+                return None
+            path = self.Path(name)
+            try:
+                os.utime(path)
+                with open(path, 'rb') as f:
+                    data = f.read()
+            except FileNotFoundError:
+                self.size -= self.entry.pop(name)
+                return None
+            self.entry.move_to_end(name)
+            return data
+
+    def Put(self, name, filename):
+        # store a copy of `filename`; returns nothing, read it back with `Read`
+        CopyFile(filename, self.Path(name))
+        with self.lock:
+            self.size -= self.entry.pop(name, 0)
+            self.entry[name] = os.path.getsize(self.Path(name))
+            self.size += self.entry[name]
+            # keep the newest font even if it alone is over capacity
+            while self.size > self.capacity and len(self.entry) > 1:
+                old, size = self.entry.popitem(last=False)
+                self.size -= size
+                try:
+                    os.unlink(self.Path(old))
+                except FileNotFoundError:
+                    pass
+
+
+class FontService:
+    def __init__(self, store, jobs=None, cache=None):
+        self.store = store
+        self.jobs = jobs or os.cpu_count()
+        self.cache = cache
+        self.servers = SourceServerGroup(None, max(1, self.jobs // 2))
+        # one build at a time, each using all jobs; a request for a font being
+        # built waits and then finds it in the store
+        self.lock = threading.Lock()
+
+    def Font(self, param):
+        # file name and content of the font of `param`
+        name = configure.GenerateFilename(param) + ".otf"
+        data = self.store.Read(name)
+        if data is not None:
+            return name, data
+        with self.lock:
+            data = self.store.Read(name)
+            if data is not None:
+                return name, data
+            target = "build/final-otf/" + name
+            builder = Builder(configure.FontMakefile([param]), jobs=self.jobs, cache=self.cache, servers=self.servers)
+            builder.Run([target])
+            self.store.Put(name, target)
+            with open(target, 'rb') as f:
+                return name, f.read()
+
+    def Close(self):
+        self.servers.Close()
+
+
+class FontRequestHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        url = urlsplit(self.path)
+        if url.path != "/font":
+            self.Reply(404, "not found: {}\n".format(url.path))
+            return
+        try:
+            param = ParseQuery(url.query)
+        except ValueError as e:
+            self.Reply(400, "{}\n".format(e))
+            return
+        try:
+            name, data = self.server.service.Font(param)
+        except BuildError as e:
+            self.Reply(500, "build failed: {}\n".format(e))
+            return
+        except Exception as e:
+            self.Reply(500, "build failed: {}: {}\n".format(type(e).__name__, e))
+            return
+        self.send_response(200)
+        self.send_header("Content-Type", "font/otf")
+        self.send_header("Content-Length", str(len(data)))
+        self.send_header("Content-Disposition", 'attachment; filename="{}"'.format(name))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def Reply(self, code, text):
+        data = text.encode()
+        self.send_response(code)
+        self.send_header("Content-Type", "text/plain; charset=utf-8")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def address_string(self):
+        # clients of a Unix socket have no address
+        return self.client_address[0] if isinstance(self.client_address, tuple) else "local"
+
+
+class UnixHTTPServer(socketserver.ThreadingMixIn, socketserver.UnixStreamServer):
+    daemon_threads = True
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="build Nowar fonts on request, over HTTP")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8400)
+    parser.add_argument("--socket", default=None, help="listen on a Unix socket instead")
+    parser.add_argument("-j", "--jobs", type=int, default=None)
+    parser.add_argument("--store-dir", default="build/serve")
+    parser.add_argument("--store-size", type=float, default=2048,
+                        help="size of finished fonts kept, in MiB")
+    parser.add_argument("--cache-dir", default=os.environ.get("NOWAR_BUILD_CACHE", "build/cache"))
+    parser.add_argument("--no-cache", action="store_true")
+    args = parser.parse_args()
+
+    store = FontStore(args.store_dir, int(args.store_size * 2 ** 20))
+    cache = None if args.no_cache else BuildCache(args.cache_dir)
+    service = FontService(store, jobs=args.jobs, cache=cache)
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, FontRequestHandler)
+    else:
+        server = ThreadingHTTPServer((args.host, args.port), FontRequestHandler)
+    server.service = service
+    print("serving on {}".format(args.socket or "http://{}:{}/font".format(args.host, args.port)), file=sys.stderr, flush=True)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        service.Close()
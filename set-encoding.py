@@ -1,23 +1,28 @@
 import sys
 import json
 
-from libotd.otz import ReadOtz, WriteOtz
+from sfnt import SetCodePageRange
 import configure
 
-if __name__ == '__main__':
-    param = sys.argv[1]
-    param = json.loads(param)
 
+def SetEncoding(param):
     dep = {**param, "encoding": "unspec"}
 
-    baseFont = ReadOtz(f"build/otd/{configure.GenerateFilename(dep)}.otz")
+    # derive the encoding variant from the finished `unspec` font,
+    # only OS/2 `ulCodePageRange1` and the checksums differ
+    with open(f"build/final-otf/{configure.GenerateFilename(dep)}.otf", 'rb') as f:
+        data = bytearray(f.read())
 
     if param["encoding"] == "abg":
-        baseFont['OS_2']['ulCodePageRange1']["gbk"] = True
-        baseFont['OS_2']['ulCodePageRange1']["big5"] = True
-        baseFont['OS_2']['ulCodePageRange1']["jis"] = True
-        baseFont['OS_2']['ulCodePageRange1']["korean"] = True
+        SetCodePageRange(data, ["gbk", "big5", "jis", "korean"])
     else:
-        baseFont['OS_2']['ulCodePageRange1'][param["encoding"]] = True
+        SetCodePageRange(data, [param["encoding"]])
+
+    with open(f"build/final-otf/{configure.GenerateFilename(param)}.otf", 'wb') as f:
+        f.write(data)
 
-    WriteOtz(baseFont, f"build/otd/{configure.GenerateFilename(param)}.otz")
+
+if __name__ == '__main__':
+    param = sys.argv[1]
+    param = json.loads(param)
+    SetEncoding(param)
@@ -0,0 +1,202 @@
+import struct
+
+
+# minimal SFNT (OpenType) binary access, for stages that patch a compiled font
+# in place instead of decompiling and recompiling every table
+offsetTableFormat = struct.Struct(">4sHHHH")
+tableRecordFormat = struct.Struct(">4sIII")
+
+checksumMagic = 0xB1B0AFBA
+headChecksumAdjustment = 8
+os2CodePageRange1 = 78
+
+# OS/2 ulCodePageRange1 bits, named as in otfcc JSON
+codePageBit = {
+    "latin1": 0,
+    "latin2": 1,
+    "cyrillic": 2,
+    "greek": 3,
+    "turkish": 4,
+    "hebrew": 5,
+    "arabic": 6,
+    "windowsBaltic": 7,
+    "vietnamese": 8,
+    "thai": 16,
+    "jis": 17,
+    "gbk": 18,
+    "korean": 19,
+    "big5": 20,
+    "johab": 21,
+    "macRoman": 29,
+    "oem": 30,
+    "symbol": 31,
+}
+
+
+def Pad4(n):
+    return (n + 3) & ~3
+
+
+def CalcChecksum(data):
+    data = bytes(data) + b'\0' * (Pad4(len(data)) - len(data))
+    return sum(struct.unpack(">{}I".format(len(data) // 4), data)) & 0xFFFFFFFF
+
+
+def ReadTableDirectory(data):
+    sfntVersion, numTables, _, _, _ = offsetTableFormat.unpack_from(data, 0)
+    directory = {}
+    for i in range(numTables):
+        tag, checksum, offset, length = tableRecordFormat.unpack_from(data, offsetTableFormat.size + tableRecordFormat.size * i)
+        directory[tag.decode('latin-1')] = [checksum, offset, length]
+    return directory
+
+
+def TableData(data, directory, tag):
+    _, offset, length = directory[tag]
+    return data[offset:offset + length]
+
+
+def WriteTableChecksum(data, directory, tag):
+    tags = list(directory)
+    _, offset, length = directory[tag]
+    checksum = CalcChecksum(data[offset:offset + length])
+    directory[tag][0] = checksum
+    struct.pack_into(">I", data, offsetTableFormat.size + tableRecordFormat.size * tags.index(tag) + 4, checksum)
+
+
+def WriteChecksumAdjustment(data, directory):
+    _, headOffset, _ = directory["head"]
+    struct.pack_into(">I", data, headOffset + headChecksumAdjustment, 0)
+    WriteTableChecksum(data, directory, "head")
+    adjustment = (checksumMagic - CalcChecksum(data)) & 0xFFFFFFFF
+    struct.pack_into(">I", data, headOffset + headChecksumAdjustment, adjustment)
+
+
+def SetCodePageRange(data, codePage):
+    # data: bytearray of a whole font, patched in place
+    directory = ReadTableDirectory(data)
+    _, offset, length = directory["OS/2"]
+    if length < os2CodePageRange1 + 4:
+        raise ValueError("OS/2 table version 0 has no code page range")
+    range1, = struct.unpack_from(">I", data, offset + os2CodePageRange1)
+    for cp in codePage:
+        range1 |= 1 << codePageBit[cp]
+    struct.pack_into(">I", data, offset + os2CodePageRange1, range1)
+    WriteTableChecksum(data, directory, "OS/2")
+    WriteChecksumAdjustment(data, directory)
+
+
+# cmap subtables in order of preference, as (platform, encoding)
+cmapPreference = [(3, 10), (0, 6), (0, 4), (3, 1), (0, 3), (0, 2), (0, 1), (0, 0)]
+
+
+def ReadCmapFormat4(data, offset):
+    segCountX2, = struct.unpack_from(">H", data, offset + 6)
+    segCount = segCountX2 // 2
+    endCode = struct.unpack_from(">{}H".format(segCount), data, offset + 14)
+    startCode = struct.unpack_from(">{}H".format(segCount), data, offset + 16 + segCountX2)
+    idDelta = struct.unpack_from(">{}H".format(segCount), data, offset + 16 + 2 * segCountX2)
+    rangeOffsetBase = offset + 16 + 3 * segCountX2
+    idRangeOffset = struct.unpack_from(">{}H".format(segCount), data, rangeOffsetBase)
+    cmap = {}
+    for i in range(segCount):
+        if startCode[i] == 0xFFFF:
+            continue
+        if idRangeOffset[i] == 0:
+            for cp in range(startCode[i], endCode[i] + 1):
+                gid = (cp + idDelta[i]) & 0xFFFF
+                if gid:
+                    cmap[cp] = gid
+        else:
+            # idRangeOffset is relative to its own position in the array
+            base = rangeOffsetBase + 2 * i + idRangeOffset[i] - 2 * startCode[i]
+            for cp in range(startCode[i], endCode[i] + 1):
+                gid, = struct.unpack_from(">H", data, base + 2 * cp)
+                if gid:
+                    cmap[cp] = (gid + idDelta[i]) & 0xFFFF
+    return cmap
+
+
+def ReadCmapFormat12(data, offset):
+    numGroups, = struct.unpack_from(">I", data, offset + 12)
+    cmap = {}
+    for i in range(numGroups):
+        start, end, gid = struct.unpack_from(">III", data, offset + 16 + 12 * i)
+        for cp in range(start, end + 1):
+            cmap[cp] = gid + cp - start
+    return cmap
+
+
+def ReadCmap(data):
+    # best Unicode cmap subtable as {code point: glyph id}
+    directory = ReadTableDirectory(data)
+    _, cmapOffset, _ = directory["cmap"]
+    _, numTables = struct.unpack_from(">HH", data, cmapOffset)
+    subtable = {}
+    for i in range(numTables):
+        platform, encoding, offset = struct.unpack_from(">HHI", data, cmapOffset + 4 + 8 * i)
+        subtable.setdefault((platform, encoding), cmapOffset + offset)
+
+    readers = {4: ReadCmapFormat4, 12: ReadCmapFormat12}
+    for key in cmapPreference:
+        if key not in subtable:
+            continue
+        offset = subtable[key]
+        fmt, = struct.unpack_from(">H", data, offset)
+        if fmt in readers:
+            return readers[fmt](data, offset)
+    raise ValueError("no supported Unicode cmap subtable")
+
+
+def SearchParameter(n, unit):
+    # searchRange, entrySelector and rangeShift of a binary-searchable array
+    entrySelector = max(n, 1).bit_length() - 1
+    searchRange = unit << entrySelector
+    return searchRange, entrySelector, n * unit - searchRange
+
+
+def BuildKernTable(subtables):
+    # `kern` version 0 with horizontal format 0 subtables,
+    # each subtable a {(left glyph id, right glyph id): value} dict
+    out = bytearray(struct.pack(">HH", 0, len(subtables)))
+    for pairs in subtables:
+        nPairs = len(pairs)
+        # the 16-bit length overflows past 10920 pairs; readers then rely on nPairs
+        length = (14 + 6 * nPairs) & 0xFFFF
+        out += struct.pack(">HHBB", 0, length, 0, 0b00000001)
+        out += struct.pack(">HHHH", nPairs, *SearchParameter(nPairs, 6))
+        for (left, right), value in sorted(pairs.items()):
+            out += struct.pack(">HHh", left, right, value)
+    return bytes(out)
+
+
+def SetTable(data, tag, table):
+    # returns a new font with `tag` added or replaced.
+    # other tables are copied byte for byte, only the directory and the
+    # `head` checksum adjustment are recomputed.
+    directory = ReadTableDirectory(data)
+    sfntVersion, = struct.unpack_from(">4s", data, 0)
+    record = {t: (checksum, data[offset:offset + length]) for t, (checksum, offset, length) in directory.items()}
+    # keep the original layout, a new table goes last
+    order = sorted((t for t in directory if t != tag), key=lambda t: directory[t][1]) + [tag]
+    record[tag] = (CalcChecksum(table), table)
+
+    numTables = len(order)
+    position = offsetTableFormat.size + tableRecordFormat.size * numTables
+    offset = {}
+    for t in order:
+        offset[t] = position
+        position += Pad4(len(record[t][1]))
+
+    out = bytearray(position)
+    offsetTableFormat.pack_into(out, 0, sfntVersion, numTables, *SearchParameter(numTables, 16))
+    for i, t in enumerate(sorted(order)):
+        checksum, content = record[t]
+        tableRecordFormat.pack_into(out, offsetTableFormat.size + tableRecordFormat.size * i,
+                                    t.encode('latin-1'), checksum, offset[t], len(content))
+    for t in order:
+        content = record[t][1]
+        out[offset[t]:offset[t] + len(content)] = content
+
+    WriteChecksumAdjustment(out, ReadTableDirectory(out))
+    return out
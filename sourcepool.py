@@ -0,0 +1,267 @@
+import os
+import sys
+import marshal
+import hashlib
+import threading
+import traceback
+import multiprocessing
+
+import configure
+from otb import ReadFont
+from otdfont import Cmap
+from stagememory import ChildPeakRss, PeakRss
+
+
+sourceDirectory = {
+    "Latin": "build/noto",
+    "Numeral": "build/noto",
+    "Roman": "build/roman",
+    "CJK": "build/shs",
+}
+
+
+def SourcePath(role, dep):
+    return "{}/{}.otz".format(sourceDirectory[role], configure.GenerateFilename(dep))
+
+
+class SourcePool:
+    # parsed source fonts, each table kept as a marshalled blob.
+    # a view unmarshals the blobs into a fresh, freely mutable font; blobs are
+    # never written after loading, so processes forked from the pool share them.
+    def __init__(self, capacity=8):
+        self.capacity = capacity
+        self.source = {}
+        self.digest = {}
+
+    def Load(self, filename):
+        stat = os.stat(filename)
+        key = (stat.st_mtime_ns, stat.st_size)
+        entry = self.source.pop(filename, None)
+        if entry is None or entry[0] != key:
+            font = ReadFont(filename)
+            if 'cmap' in font:
+                font['cmap'] = Cmap.FromJson(font['cmap']).Pack()
+            entry = (key, {table: marshal.dumps(value) for table, value in font.items()})
+        self.source[filename] = entry
+        while len(self.source) > self.capacity:
+            del self.source[next(iter(self.source))]
+        return entry[1]
+
+    def Digest(self, filename):
+        # content digest of a source, remembered by mtime and size
+        stat = os.stat(filename)
+        key = (stat.st_mtime_ns, stat.st_size)
+        if self.digest.get(filename, (None,))[0] != key:
+            with open(filename, 'rb') as f:
+                self.digest[filename] = (key, hashlib.sha256(f.read()).hexdigest()[:24])
+        return self.digest[filename][1]
+
+    def View(self, filename):
+        font = {table: marshal.loads(blob) for table, blob in self.Load(filename).items()}
+        if 'cmap' in font:
+            font['cmap'] = Cmap.Unpack(font['cmap'])
+        return font
+
+    def Preload(self, param):
+        for role, dep in configure.ResolveDependency(param).items():
+            self.Load(SourcePath(role, dep))
+
+
+pool = SourcePool()
+
+
+def PoolKey(param):
+    return SourcePath("CJK", configure.ResolveDependency(param)["CJK"])
+
+
+def Serve(conn):
+    import merge
+
+    lock = threading.Lock()
+
+    def reap(target, pid):
+        _, status, usage = os.wait4(pid, 0)
+        code = os.waitstatus_to_exitcode(status)
+        error = "merge exited with status {}".format(code) if code else None
+        with lock:
+            conn.send((target, error, ChildPeakRss(usage)))
+
+    while True:
+        message = conn.recv()
+        if message is None:
+            break
+        target, param = message
+        try:
+            # the merged base is built here once and inherited by every variant
+            merge.GetBase(param)
+        except Exception as e:
+            with lock:
+                conn.send((target, "{}: {}".format(type(e).__name__, e), None))
+            continue
+        sys.stdout.flush()
+        sys.stderr.flush()
+        pid = os.fork()
+        if pid == 0:
+            code = 0
+            try:
+                merge.Merge(param)
+            except BaseException:
+                traceback.print_exc()
+                code = 1
+            sys.stdout.flush()
+            sys.stderr.flush()
+            os._exit(code)
+        threading.Thread(target=reap, args=(target, pid), daemon=True).start()
+
+
+class SourceServer:
+    # a process holding the sources and merged bases of one CJK dependency.
+    # merge jobs are forked from it and read them through copy-on-write pages.
+    def __init__(self, callback):
+        context = multiprocessing.get_context("fork")
+        self.conn, child = context.Pipe()
+        self.process = context.Process(target=Serve, args=(child,), daemon=True)
+        self.process.start()
+        child.close()
+        self.lock = threading.Lock()
+        # targets submitted and not reported yet
+        self.running = set()
+        self.alive = True
+        # (StageMemory, estimate) the server is charged to
+        self.reserved = None
+        self.reader = threading.Thread(target=self.Read, args=(callback,), daemon=True)
+        self.reader.start()
+
+    def Read(self, callback):
+        while True:
+            try:
+                result = self.conn.recv()
+            except (EOFError, OSError):
+                break
+            with self.lock:
+                self.running.discard(result[0])
+            callback(result)
+        # the server is gone, e.g. to the OOM killer, and the merges it was
+        # running with it; report them, the build would wait forever
+        self.process.join(timeout=5)
+        with self.lock:
+            self.alive = False
+            lost, self.running = self.running, set()
+        for target in sorted(lost):
+            callback((target, "source server exited with status {}".format(self.process.exitcode), None))
+
+    def Submit(self, target, param):
+        # False if the server is gone
+        with self.lock:
+            if not self.alive:
+                return False
+            self.running.add(target)
+        try:
+            self.conn.send((target, param))
+        except OSError:
+            # the reader reports it with the rest
+            pass
+        return True
+
+    def Close(self):
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(timeout=5)
+        if self.process.is_alive():
+            self.process.terminate()
+
+
+class SourceServerGroup:
+    # at most `capacity` servers; a merge needing a new server while all of
+    # them are busy waits until one goes idle and can be retired. a live
+    # server is charged to `memory`, the budget of the jobs, until retired
+    def __init__(self, callback, capacity, memory=None):
+        self.callback = callback
+        self.capacity = capacity
+        self.memory = memory
+        self.server = {}
+        self.lock = threading.Lock()
+        self.queued = []
+
+    def Callback(self, result):
+        # servers may outlive a build, results go to the current one
+        self.callback(result)
+        with self.lock:
+            self.Dispatch()
+
+    def Has(self, param):
+        return PoolKey(param) in self.server
+
+    def Charge(self, memory):
+        # servers may outlive a build, they count against the current one
+        with self.lock:
+            self.memory = memory
+            for server in self.server.values():
+                self.Release(server)
+                self.Reserve(server)
+
+    def Reserve(self, server):
+        if self.memory:
+            estimate = self.memory.Estimate("source-server")
+            self.memory.Acquire(estimate)
+            server.reserved = (self.memory, estimate)
+
+    def Release(self, server):
+        if server.reserved:
+            memory, estimate = server.reserved
+            memory.Record("source-server", PeakRss(server.process.pid))
+            memory.Release(estimate)
+            server.reserved = None
+
+    def Start(self):
+        server = SourceServer(self.Callback)
+        self.Reserve(server)
+        return server
+
+    def Stop(self, server):
+        self.Release(server)
+        server.Close()
+
+    def Submit(self, target, param):
+        with self.lock:
+            self.queued.append((target, param))
+            self.Dispatch()
+
+    def Dispatch(self):
+        # start the queued merges that have a server or room for one, in
+        # order; called with the lock held
+        waiting = []
+        for target, param in self.queued:
+            key = PoolKey(param)
+            server = self.server.pop(key, None)
+            if server is not None and not server.alive:
+                self.Stop(server)
+                server = None
+            if server is None:
+                self.Retire(self.capacity - 1)
+                if len(self.server) >= self.capacity:
+                    waiting.append((target, param))
+                    continue
+                server = self.Start()
+            while not server.Submit(target, param):
+                self.Stop(server)
+                server = self.Start()
+            self.server[key] = server
+        self.queued = waiting
+
+    def Retire(self, count):
+        # retire idle servers, least recently used first, down to `count`
+        for k in list(self.server):
+            if len(self.server) <= count:
+                break
+            if not self.server[k].running:
+                self.Stop(self.server.pop(k))
+
+    def Close(self):
+        with self.lock:
+            for server in self.server.values():
+                self.Stop(server)
+            self.server = {}
+            self.queued = []
@@ -0,0 +1,150 @@
+import os
+import json
+import threading
+import resource
+import tempfile
+import subprocess
+
+
+# peak memory of build jobs by class, in MiB.
+#
+# a job is admitted only while the estimates of the running jobs fit the
+# memory budget. estimates start from the declared peaks below and are
+# replaced by the peaks measured in the last run that ran the class.
+declaredPeak = {
+    "instancer": 8192,  # a batch of 4 threads, --max-old-space-size=2048 each
+    "otfccdump": 1536,
+    "otfccbuild": 3072,
+    "merge": 2048,
+    "merge-roman": 4096,  # Pinyin and Romaja compose thousands of glyphs
+    "kern": 512,
+    "set-encoding": 256,
+    "pack": 6144,  # 7z, as below
+    # resident for as long as it is kept: the parsed sources of one CJK
+    # dependency and the two merged bases it caches
+    "source-server": 4096,
+    "7z": 6144,  # LZMA with a 512 MiB dictionary
+    "shell": 64,
+}
+
+# shell commands by the first pattern they contain
+commandClass = [
+    ("instancer", "instancer.js"),
+    ("otfccbuild", "otfccbuild"),
+    ("otfccdump", "otfccdump"),
+    ("7z", "7z "),
+]
+
+headroom = 1.1
+
+
+def StageClass(stage, command):
+    if stage:
+        name, param = stage
+        if name == "merge" and ("Pinyin" in param["feature"] or "Romaja" in param["feature"]):
+            return "merge-roman"
+        return name
+    for name, pattern in commandClass:
+        if any(pattern in c for c in command):
+            return name
+    return "shell"
+
+
+def ResetPeakRss():
+    # start a new peak for this process, where the kernel allows it
+    try:
+        with open("/proc/self/clear_refs", 'w') as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def PeakRss(pid="self"):
+    # peak resident set in MiB of this process since the last reset, or of
+    # another running process; None if that one is gone
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    if pid != "self":
+        return None
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def ChildPeakRss(usage):
+    # peak resident set in MiB from the rusage of a reaped child; it covers
+    # the child's own reaped children, e.g. the commands of a shell pipeline
+    return usage.ru_maxrss / 1024
+
+
+# highest peak of the children run by `RunChild` since the last reset,
+# for stages that run external tools in process
+childPeak = 0
+
+
+def RunChild(args, **kwargs):
+    # as `subprocess.call`, recording the child's peak memory
+    global childPeak
+    process = subprocess.Popen(args, **kwargs)
+    _, status, usage = os.wait4(process.pid, 0)
+    process.returncode = os.waitstatus_to_exitcode(status)
+    childPeak = max(childPeak, ChildPeakRss(usage))
+    return process.returncode
+
+
+def ResetChildPeak():
+    global childPeak
+    childPeak = 0
+
+
+class StageMemory:
+    def __init__(self, budget, filename="build/stage-memory.json"):
+        # `budget` in MiB
+        self.budget = budget
+        self.filename = filename
+        self.recorded = {}
+        try:
+            with open(filename) as f:
+                self.recorded = json.load(f)
+        except (OSError, ValueError):
+            pass
+        self.measured = {}
+        self.used = 0
+        # source servers are charged from their reader threads
+        self.lock = threading.Lock()
+
+    def Estimate(self, cls):
+        return self.recorded.get(cls, declaredPeak.get(cls, declaredPeak["shell"])) * headroom
+
+    def Fits(self, estimate):
+        return self.used + estimate <= self.budget
+
+    def Acquire(self, estimate):
+        with self.lock:
+            self.used += estimate
+
+    def Release(self, estimate):
+        with self.lock:
+            self.used -= estimate
+
+    def Record(self, cls, peak):
+        if peak is not None:
+            with self.lock:
+                self.measured[cls] = max(self.measured.get(cls, 0), peak)
+
+    def Save(self):
+        if not self.measured:
+            return
+        # classes measured in this run take this run's peak, the rest are kept
+        self.recorded.update({cls: round(peak, 1) for cls, peak in self.measured.items()})
+        directory = os.path.dirname(self.filename) or "."
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=directory)
+        with os.fdopen(fd, 'w') as f:
+            json.dump(self.recorded, f, indent=1, sort_keys=True)
+        os.replace(tmp, self.filename)
+        self.measured = {}